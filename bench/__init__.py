@@ -0,0 +1,12 @@
+"""Benchmark harness: a synthetic database, a load generator and saved results.
+
+    python -m bench generate --users 100000 --buddies 10     # bench/bench.db
+    python -m bench run --serve bench/bench.db --clients 32   # start gunicorn, measure, save
+    python -m bench compare bench/results/<older>.json        # against the latest run
+
+`run` without `--serve` tests a server that is already running (`--url`).
+`run --record traffic.jsonl` saves the requests it makes, and
+`python -m bench replay traffic.jsonl` sends them again. A replay file has one
+request per line: {"t": seconds, "user": id, "auth": "session"|"basic"|"bearer",
+"method": ..., "path": ..., "form": {...}}.
+"""
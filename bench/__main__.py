@@ -0,0 +1,147 @@
+"""Benchmark commands; see bench/__init__.py"""
+import contextlib, json, os, socket, subprocess, sys, time
+import click
+from . import dataset, load, report
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DB = os.path.join(REPO, "bench", "bench.db")
+
+
+@click.group()
+def cli():
+    """Generate a synthetic database, load-test the app and compare the results"""
+
+
+@cli.command()
+@click.argument("path", default=DEFAULT_DB)
+@click.option("--users", default=10000, show_default=True)
+@click.option("--buddies", default=10, show_default=True, help="Average number of users each user adds")
+@click.option("--mutual", default=0.6, show_default=True, help="Fraction of buddy requests that are returned")
+@click.option("--seed", default=1, show_default=True)
+@click.option("--force", is_flag=True, help="Replace an existing database")
+def generate(path, users, buddies, mutual, seed, force):
+    """Write a synthetic users database to PATH"""
+    if os.path.exists(path):
+        if not force:
+            raise click.ClickException(f"{path} exists (use --force to replace it)")
+        for suffix in ["", "-wal", "-shm", ".json"]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path + suffix)
+    meta = dataset.generate(path, users, buddies, mutual, seed)
+    dataset.write_meta(path, meta)
+    click.echo(f"{path}: {dataset.describe(path)}")
+
+
+@contextlib.contextmanager
+def server(url, db, workers):
+    """Run the app with gunicorn on `db` while the block runs (if `db` is set)"""
+    if not db:
+        yield
+        return
+    host_port = url.split("://", 1)[-1].rstrip("/")
+    # all the clients come from one address, so the per-IP rate limits would throttle them
+    app = f"headbook:create_app({{'DATABASE': {os.path.abspath(db)!r}, 'RATE_LIMITS': {{}}}})"
+    cmd = [sys.executable, "-m", "gunicorn", "--bind", host_port, "--access-logfile", "-", app]
+    if workers:
+        cmd[3:3] = ["--workers", str(workers)]
+    with open(os.path.join(REPO, "bench", "server.log"), "w") as log:
+        proc = subprocess.Popen(cmd, cwd=REPO, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            (host, port) = host_port.rsplit(":", 1)
+            deadline = time.monotonic() + 30
+            while True:
+                with contextlib.suppress(OSError), socket.create_connection((host, int(port)), timeout=1):
+                    break
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise click.ClickException("server didn't start; see bench/server.log")
+                time.sleep(0.2)
+            yield
+        finally:
+            proc.terminate()
+            proc.wait(30)
+
+
+def finish(results, elapsed, settings, save):
+    summary = report.summarize(results, elapsed)
+    click.echo(report.format_table(summary))
+    if save:
+        click.echo(f"saved {report.save(summary, settings)}")
+
+
+server_options = [
+    click.option("--url", default="http://127.0.0.1:5055", show_default=True),
+    click.option("--serve", "serve_db", metavar="DB", help="Start the app (with gunicorn) on this database first"),
+    click.option("--workers", type=int, help="gunicorn workers, with --serve (default: see gunicorn.conf.py)"),
+    click.option("--clients", default=16, show_default=True, help="Concurrent clients"),
+    click.option("--save/--no-save", default=True, show_default=True, help="Save the results in bench/results/"),
+]
+
+
+def with_server_options(f):
+    for option in reversed(server_options):
+        f = option(f)
+    return f
+
+
+@cli.command()
+@with_server_options
+@click.option("--db", default=DEFAULT_DB, show_default=True, help="The synthetic database the server uses (for its seed and size)")
+@click.option("--duration", default=30.0, show_default=True, help="Seconds to measure")
+@click.option("--warmup", default=5.0, show_default=True, help="Seconds to run before measuring")
+@click.option("--auth", default="session,basic,bearer", show_default=True, help="Authentication modes to cycle through")
+@click.option("--record", type=click.File("w"), help="Write the requests made to this file, for replay")
+def run(url, serve_db, workers, clients, save, db, duration, warmup, auth, record):
+    """Send a mix of requests from concurrent clients, and report latency per route"""
+    meta = dataset.read_meta(serve_db or db)
+    if not meta:
+        raise click.ClickException(f"no {(serve_db or db)}.json; make the database with 'python -m bench generate'")
+    modes = [m.strip() for m in auth.split(",") if m.strip()]
+    if not set(modes) <= set(load.AUTH_MODES):
+        raise click.BadParameter(f"must be some of {', '.join(load.AUTH_MODES)}", param_hint="--auth")
+    recorder = load.Recorder(record) if record else None
+    with server(url, serve_db, workers):
+        results = load.run(url, meta["users"], meta["seed"], clients, duration, warmup, modes, recorder=recorder)
+    settings = {"mode": "run", "dataset": meta, "clients": clients, "duration": duration, "warmup": warmup,
+                "auth": modes, "workers": workers}
+    finish(results, duration, settings, save)
+
+
+@cli.command()
+@with_server_options
+@click.argument("traffic", type=click.File("r"))
+@click.option("--seed", default=1, show_default=True, help="Seed of the synthetic database (for access tokens)")
+@click.option("--speed", default=1.0, show_default=True, help="Replay speed; 0 = as fast as possible")
+def replay(url, serve_db, workers, clients, save, traffic, seed, speed):
+    """Replay recorded requests (JSON Lines, as written by 'run --record')"""
+    with server(url, serve_db, workers):
+        (results, skipped, elapsed) = load.replay(url, traffic, seed, clients, speed)
+    if skipped:
+        click.echo(f"skipped {skipped} lines without a method and path", err=True)
+    settings = {"mode": "replay", "traffic": traffic.name, "clients": clients, "speed": speed, "workers": workers}
+    finish(results, elapsed, settings, save)
+
+
+@cli.command()
+@click.argument("old", type=click.Path(exists=True))
+@click.argument("new", type=click.Path(exists=True), required=False)
+def compare(old, new):
+    """Compare two saved results (NEW defaults to the latest one)"""
+    if new is None:
+        saved = sorted(os.listdir(report.RESULTS_DIR)) if os.path.isdir(report.RESULTS_DIR) else []
+        if not saved:
+            raise click.ClickException("no saved results")
+        new = os.path.join(report.RESULTS_DIR, saved[-1])
+    click.echo(report.compare(report.load(old), report.load(new)))
+
+
+@cli.command()
+@click.argument("path", type=click.Path(exists=True))
+def show(path):
+    """Print a saved result"""
+    doc = report.load(path)
+    click.echo(f"{doc.get('commit')}{' (dirty)' if doc.get('dirty') else ''} {doc.get('date')} {json.dumps(doc.get('settings'))}")
+    click.echo(report.format_table(doc))
+
+
+if __name__ == "__main__":
+    cli()
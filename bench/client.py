@@ -0,0 +1,80 @@
+"""A minimal HTTP client for the load generator: one keep-alive connection, a
+cookie jar, and session (cookie), Basic or Bearer authentication."""
+import base64, http.client, re, time, urllib.parse
+from http.cookies import SimpleCookie
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class Response:
+    def __init__(self, status, headers, body, elapsed):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.elapsed = elapsed  # seconds, from sending the request to reading the whole body
+
+    @property
+    def text(self):
+        return self.body.decode(errors="replace")
+
+
+class Client:
+    def __init__(self, url, auth="session", username=None, password=None, token=None, timeout=30):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.auth = auth
+        self.username = username
+        self.password = password
+        self.token = token
+        self.timeout = timeout
+        self.cookies = {}
+        self.csrf = ""  # CSRF token from the last page with a form
+        self.conn = None
+
+    def headers(self, extra=None):
+        headers = {"Accept": "application/json"}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for (k, v) in self.cookies.items())
+        if self.auth == "basic":
+            credentials = base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
+            headers["Authorization"] = f"Basic {credentials}"
+        elif self.auth == "bearer":
+            headers["Authorization"] = f"Bearer {self.token}"
+        headers.update(extra or {})
+        return headers
+
+    def request(self, method, path, form=None, headers=None):
+        body = urllib.parse.urlencode(form) if form is not None else None
+        headers = self.headers(headers)
+        if body is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            start = time.perf_counter()
+            try:
+                self.conn.request(method, path, body, headers)
+                resp = self.conn.getresponse()
+                data = resp.read()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # the server may have closed an idle keep-alive connection; retry once
+                self.close()
+                if attempt == 2:
+                    raise
+        elapsed = time.perf_counter() - start
+        for value in resp.headers.get_all("Set-Cookie") or []:
+            for (name, morsel) in SimpleCookie(value).items():
+                self.cookies[name] = morsel.value
+        response = Response(resp.status, resp.headers, data, elapsed)
+        if resp.headers.get_content_type() == "text/html":
+            match = CSRF_TOKEN.search(response.text)
+            if match:
+                self.csrf = match[1]
+        return response
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,115 @@
+"""A synthetic HeadBook database of any size, the same for the same seed.
+
+Users are called `user1` … `userN` (with ids 1 … N), all with the same password,
+and each has one access token that the load generator can work out from the
+seed (see `token_for()`). Buddies follow a skewed distribution: a few users
+are very popular, and many requests are returned.
+"""
+import hashlib, json, random
+from datetime import date, timedelta
+import apsw
+from werkzeug.security import generate_password_hash
+from headbook.bulk import import_rows, user_row, Progress
+from headbook.migrations import migrate
+from headbook.passwords import hash_token
+
+PASSWORD = "bench-password"
+COLORS = ["red", "blue", "green", "purple", "black", "orange", "pink", "cyan", "white"]
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut "
+         "labore et dolore magna aliqua chess hiking cooking jazz climbing poetry sailing").split()
+HOBBIES = ["chess", "hiking", "cooking", "jazz", "climbing", "poetry", "sailing"]
+
+
+def username_for(user_id):
+    return f"user{user_id}"
+
+
+def token_for(seed, user_id):
+    """The access token of a synthetic user"""
+    return hashlib.sha256(f"headbook-bench:{seed}:{user_id}".encode()).hexdigest()
+
+
+def user_records(rng, count, pwhash):
+    start = date(1950, 1, 1)
+    for user_id in range(1, count + 1):
+        record = {
+            "id": user_id,
+            "username": username_for(user_id),
+            "password": pwhash,
+            "color": rng.choice(COLORS),
+            "about": " ".join(rng.choices(WORDS, k=rng.randint(3, 30))),
+        }
+        if rng.random() < 0.7:
+            record["birthdate"] = (start + timedelta(days=rng.randrange(20000))).isoformat()
+        if rng.random() < 0.5:
+            record["picture_url"] = f"https://example.com/pictures/{user_id}.png"
+        if rng.random() < 0.2:
+            record["info"] = {"hobby": rng.choice(HOBBIES)}  # a field without a column of its own
+        yield record
+
+
+def buddy_edges(rng, count, per_user, mutual):
+    """(user1_id, user2_id) edges; each user adds about `per_user` others, and
+    a fraction `mutual` of the added users add them back"""
+    for user_id in range(1, count + 1):
+        for _ in range(rng.randint(0, 2 * per_user)):
+            # squaring the random number makes low ids much more popular
+            other = int(count * rng.random() ** 2) + 1
+            if other != user_id:
+                yield (user_id, other)
+                if rng.random() < mutual:
+                    yield (other, user_id)
+
+
+def generate(path, users=10000, buddies=10, mutual=0.6, seed=1, method="scrypt:32768:8:1"):
+    """Write a synthetic database to `path` (which should not exist yet)"""
+    rng = random.Random(seed)
+    conn = apsw.Connection(path)
+    conn.pragma("journal_mode", "wal")
+    conn.pragma("synchronous", "off")  # nothing to lose if generating fails half-way
+    migrate(conn)
+    with conn:
+        # no example users, so ids and usernames match
+        for table in ["buddies", "tokens", "users"]:
+            conn.execute(f"DELETE FROM {table};")
+
+    # all users get the same password, so it only has to be hashed once
+    pwhash = generate_password_hash(PASSWORD, method)
+    progress = Progress("users")
+    import_rows(conn, "users", (user_row(r, False) for r in user_records(rng, users, pwhash)), progress=progress)
+    progress.report()
+
+    progress = Progress("tokens")
+    tokens = ((user_id, hash_token(token_for(seed, user_id)), "bench") for user_id in range(1, users + 1))
+    import_rows(conn, "tokens", tokens, progress=progress)
+    progress.report()
+
+    progress = Progress("buddies")
+    import_rows(conn, "buddies", buddy_edges(rng, users, buddies, mutual), on_conflict="ignore", progress=progress)
+    progress.report()
+
+    conn.execute("ANALYZE;")
+    conn.close()
+    return {"users": users, "buddies": buddies, "mutual": mutual, "seed": seed}
+
+
+def describe(path):
+    """Sizes of the tables in a (synthetic) database, and how it was made"""
+    conn = apsw.Connection(path, flags=apsw.SQLITE_OPEN_READONLY)
+    sizes = {table: conn.execute(f"SELECT count(*) FROM {table};").fetchone()[0] for table in ["users", "tokens", "buddies"]}
+    conn.close()
+    return sizes
+
+
+def write_meta(path, meta):
+    with open(path + ".json", "w") as f:
+        json.dump(meta, f)
+
+
+def read_meta(path):
+    """How a synthetic database was made (seed etc.), or {} if we don't know"""
+    try:
+        with open(path + ".json") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
@@ -0,0 +1,221 @@
+"""Load generation: concurrent clients running a mix of requests against the
+real routes, or replaying recorded traffic.
+
+Every request is recorded as (route, status, seconds). Routes are labelled
+by method and path pattern, e.g. `GET /users/<id>`.
+"""
+import json, random, re, threading, time
+from .client import Client
+from .dataset import PASSWORD, WORDS, username_for, token_for
+
+AUTH_MODES = ["session", "basic", "bearer"]
+
+
+def route_label(method, path):
+    """`GET /users/42?x=1` -> `GET /users/<id>`"""
+    path = path.split("?", 1)[0]
+    return f"{method} {re.sub(r'/[0-9]+(?=/|$)', '/<id>', path)}"
+
+
+class Worker:
+    """One simulated user, with their own connection, running requests in a loop"""
+
+    def __init__(self, url, user_id, auth, users, seed, rng, recorder=None):
+        self.user_id = user_id
+        self.users = users
+        self.rng = rng
+        self.recorder = recorder
+        self.added = []  # buddies we added, so we can remove them again
+        self.client = Client(
+            url, auth,
+            username=username_for(user_id), password=PASSWORD, token=token_for(seed, user_id),
+        )
+        self.results = []
+
+    def request(self, method, path, form=None, html=False):
+        if self.recorder:
+            self.recorder.record(self.user_id, self.client.auth, method, path, form, html)
+        try:
+            resp = self.client.request(method, path, form, {"Accept": "text/html"} if html else None)
+            self.results.append((route_label(method, path), resp.status, resp.elapsed))
+            return resp
+        except Exception:
+            self.results.append((route_label(method, path), 0, 0.0))
+            return None
+
+    def other_user(self):
+        # popular users (low ids) are looked at more often, as in the dataset
+        return int(self.users * self.rng.random() ** 2) + 1
+
+    # the actions; each makes one or more requests
+
+    def login(self):
+        self.request("GET", "/login/", html=True)
+        form = {"csrf_token": self.client.csrf, "username": username_for(self.user_id), "password": PASSWORD, "next": ""}
+        self.request("POST", "/login/", form, html=True)
+
+    def home(self):
+        self.request("GET", "/", html=True)
+
+    def list_users(self):
+        after = self.rng.randrange(self.users)
+        self.request("GET", f"/users/?after={after}&limit=100")
+
+    def get_user(self):
+        self.request("GET", f"/users/{self.other_user()}")
+
+    def get_batch(self):
+        ids = ",".join(str(self.other_user()) for _ in range(20))
+        self.request("GET", f"/users/batch?ids={ids}")
+
+    def search(self):
+        self.request("GET", f"/users/search?q={self.rng.choice(WORDS)[:3]}")
+
+    def add_buddy(self):
+        other = self.other_user()
+        if other != self.user_id:
+            self.request("POST", f"/add_buddy/{self.user_id}/{other}/")
+            self.added.append(other)
+
+    def remove_buddy(self):
+        if not self.added:
+            return self.add_buddy()
+        other = self.added.pop(self.rng.randrange(len(self.added)))
+        self.request("POST", f"/remove_buddy/{self.user_id}/{other}/")
+
+    def edit_profile(self):
+        self.request("GET", "/profile/", html=True)
+        form = {
+            "csrf_token": self.client.csrf,
+            "password": "", "password_again": "",
+            "color": self.rng.choice(["red", "blue", "green", "cyan"]),
+            "about": " ".join(self.rng.choices(WORDS, k=10)),
+        }
+        self.request("POST", "/profile/", form, html=True)
+
+
+# (action, weight) – roughly what the home page and the API see
+MIX = [
+    (Worker.home, 5),
+    (Worker.list_users, 20),
+    (Worker.get_user, 30),
+    (Worker.get_batch, 10),
+    (Worker.search, 5),
+    (Worker.add_buddy, 5),
+    (Worker.remove_buddy, 5),
+    (Worker.edit_profile, 2),
+    (Worker.login, 1),
+]
+
+
+class Recorder:
+    """Writes the requests that are made as JSON Lines, for replay()"""
+
+    def __init__(self, f):
+        self.f = f
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, user_id, auth, method, path, form=None, html=False):
+        entry = {"t": round(time.monotonic() - self.start, 4), "user": user_id, "auth": auth,
+                 "method": method, "path": path}
+        if form is not None:
+            entry["form"] = form
+        if html:
+            entry["html"] = True
+        with self.lock:
+            self.f.write(json.dumps(entry) + "\n")
+
+
+def run(url, users, seed=1, clients=16, duration=30.0, warmup=5.0, auth=AUTH_MODES, mix=MIX, recorder=None):
+    """Run `clients` concurrent workers for `warmup` + `duration` seconds.
+
+    Returns the (route, status, seconds) of every request made after the warmup.
+    """
+    rng = random.Random(seed)
+    workers = [
+        Worker(url, rng.randint(1, users), auth[i % len(auth)], users, seed, random.Random(rng.random()), recorder)
+        for i in range(clients)
+    ]
+    (actions, weights) = zip(*mix)
+    start = time.monotonic()
+    measure_from = start + warmup
+    stop = measure_from + duration
+    kept = []
+    lock = threading.Lock()
+
+    def loop(worker):
+        if worker.client.auth == "session":
+            worker.login()
+            if time.monotonic() < measure_from:
+                worker.results.clear()
+        while time.monotonic() < stop:
+            before = len(worker.results)
+            began = time.monotonic()
+            worker.rng.choices(actions, weights)[0](worker)
+            if began < measure_from:
+                del worker.results[before:]
+        with lock:
+            kept.extend(worker.results)
+        worker.client.close()
+
+    threads = [threading.Thread(target=loop, args=(w,), daemon=True) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return kept
+
+
+def replay(url, lines, seed=1, clients=16, speed=1.0):
+    """Replay recorded requests (see Recorder) against `url`.
+
+    Each user's requests are sent in order, by one of `clients` threads. With
+    `speed` > 0, requests are sent at their recorded times (divided by `speed`);
+    with 0, as fast as possible. Lines without a method and path are skipped.
+
+    Returns ((route, status, seconds) of every request, number of skipped lines, elapsed time).
+    """
+    queues = [[] for _ in range(clients)]
+    skipped = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        if not (isinstance(entry, dict) and entry.get("method") and entry.get("path")):
+            skipped += 1
+            continue
+        queues[hash(entry.get("user")) % clients].append(entry)
+
+    results = []
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def loop(entries):
+        workers = {}  # (user, auth) -> Worker
+        for entry in entries:
+            if speed > 0 and "t" in entry:
+                delay = start + entry["t"] / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            key = (entry.get("user"), entry.get("auth", "session"))
+            worker = workers.get(key)
+            if worker is None:
+                user_id = entry.get("user") or 1
+                worker = workers[key] = Worker(url, user_id, key[1], 1, seed, random.Random(seed))
+            form = entry.get("form")
+            if form and "csrf_token" in form:
+                # tokens are per session, so use the one from the page we just got
+                form = {**form, "csrf_token": worker.client.csrf}
+            worker.request(entry["method"], entry["path"], form, html=entry.get("html", False))
+        with lock:
+            for worker in workers.values():
+                results.extend(worker.results)
+                worker.client.close()
+
+    threads = [threading.Thread(target=loop, args=(q,), daemon=True) for q in queues if q]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (results, skipped, time.monotonic() - start)
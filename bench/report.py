@@ -0,0 +1,109 @@
+"""Summaries of benchmark results, saved as JSON so runs can be compared."""
+import datetime, json, os, subprocess
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))  # ceil
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(results, elapsed):
+    """Per-route and overall request counts, errors, throughput and latency percentiles (in ms)"""
+    by_route = {}
+    for (route, status, seconds) in results:
+        by_route.setdefault(route, []).append((status, seconds))
+
+    def stats(entries):
+        times = sorted(seconds for (status, seconds) in entries if status)
+        errors = sum(1 for (status, _) in entries if not status or status >= 400)
+        return {
+            "requests": len(entries),
+            "errors": errors,
+            "rps": round(len(entries) / elapsed, 2) if elapsed else None,
+            "p50": ms(percentile(times, 50)),
+            "p95": ms(percentile(times, 95)),
+            "p99": ms(percentile(times, 99)),
+            "max": ms(times[-1] if times else None),
+        }
+
+    return {
+        "routes": {route: stats(entries) for (route, entries) in sorted(by_route.items())},
+        "total": stats([(status, seconds) for (_, status, seconds) in results]),
+    }
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def git_commit():
+    """(short commit hash, whether there are uncommitted changes), or (None, None) outside git"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip())
+        return (commit, dirty)
+    except (OSError, subprocess.CalledProcessError):
+        return (None, None)
+
+
+def save(summary, settings, directory=RESULTS_DIR):
+    """Write a run's summary (with the commit and settings) to `directory`; returns the file name"""
+    (commit, dirty) = git_commit()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    doc = {"date": now.isoformat(timespec="seconds"), "commit": commit, "dirty": dirty, "settings": settings, **summary}
+    os.makedirs(directory, exist_ok=True)
+    name = f"{now:%Y%m%d-%H%M%S}-{commit or 'nogit'}{'-dirty' if dirty else ''}.json"
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=2)
+    return path
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def format_table(summary):
+    lines = [f"{'route':40} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+    rows = list(summary["routes"].items()) + [("TOTAL", summary["total"])]
+    for (route, s) in rows:
+        lines.append(
+            f"{route[:40]:40} {s['requests']:>9} {s['errors']:>7} {fmt(s['rps'])} {fmt(s['p50'])} {fmt(s['p95'])} {fmt(s['p99'])}"
+        )
+    return "\n".join(lines)
+
+
+def fmt(value, width=9):
+    return f"{'-':>{width}}" if value is None else f"{value:>{width}.2f}"
+
+
+def compare(old, new):
+    """Table of the change in throughput and latency per route, from `old` to `new` (summaries)"""
+    def change(a, b):
+        if not a or b is None:
+            return f"{'-':>8}"
+        return f"{(b - a) / a * 100:>+7.1f}%"
+
+    lines = [
+        f"old: {old.get('commit')} ({old.get('date')})   new: {new.get('commit')} ({new.get('date')})",
+        f"{'route':40} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}",
+    ]
+    routes = dict(old["routes"])
+    routes.update(new["routes"])
+    for route in list(sorted(routes)) + ["TOTAL"]:
+        a = old["total"] if route == "TOTAL" else old["routes"].get(route)
+        b = new["total"] if route == "TOTAL" else new["routes"].get(route)
+        if not (a and b):
+            lines.append(f"{route[:40]:40} {'(only in ' + ('new' if b else 'old') + ')':>8}")
+            continue
+        lines.append(
+            f"{route[:40]:40} {change(a['rps'], b['rps'])} {change(a['p50'], b['p50'])} "
+            f"{change(a['p95'], b['p95'])} {change(a['p99'], b['p99'])}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,36 @@
+"""gunicorn settings for running HeadBook with several worker processes:
+
+    flask -A headbook init-db
+    gunicorn 'headbook:create_app()'
+
+`kill -HUP <master pid>` starts fresh workers without dropping connections.
+The app is loaded once in the master process (preload_app), so the new workers
+still run the old code: after an upgrade, restart gunicorn.
+"""
+import multiprocessing, os
+
+bind = os.environ.get("HEADBOOK_BIND", "127.0.0.1:5000")
+
+# one process per core; the threads in each cover requests waiting for the
+# database or for a password hash, and open /events/ streams (up to
+# EVENTS_MAX_STREAMS of them, so leave room for other requests)
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = 16
+
+# create the app once, before forking, so workers start quickly; it doesn't open
+# the database, so each worker still gets its own connections. New code is only
+# picked up by a restart of the master, not by `kill -HUP`
+preload_app = True
+
+# replace workers now and then, so leaks can't pile up
+max_requests = 10000
+max_requests_jitter = 1000
+graceful_timeout = 10
+
+
+def post_worker_init(worker):
+    # load the buddy graph (and, with REPLICA on, copy the database into memory)
+    # before the new worker takes requests
+    import headbook.app
+    headbook.app.warm_up()
@@ -1,55 +1,355 @@
-import flask, apsw, sys, os, secrets, json, re, urllib.parse
+import flask, apsw, sys, os, secrets, json, re, copy, time, functools, math, queue, threading, urllib.parse
 from datetime import date
 from http import HTTPStatus
 from typing import Any
 from flask import (
+    Blueprint,
     Flask,
     abort,
+    before_render_template,
+    current_app,
     g,
     jsonify,
     redirect,
     request,
-    send_from_directory,
     make_response,
     render_template,
     session,
+    stream_with_context,
+    template_rendered,
     url_for,
 )
 from urllib.parse import urlparse
 from werkzeug.datastructures import WWWAuthenticate
-from werkzeug.security import generate_password_hash, check_password_hash
 from base64 import b64decode
 from box import Box
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 from .login_form import LoginForm
 from .profile_form import ProfileForm
-db = None
+from .db_pool import ConnectionPool
+from .cache import TTLCache
+from .buddy_graph import BuddyGraph
+from .migrations import migrate, check_query_plans, PROFILE_COLUMNS, SCHEMA_VERSION
+from .bulk import import_data, export_data
+from .passwords import PasswordHasher, CredentialCache, HashingBusy, hash_token
+from .metrics import Metrics
+from .log import Logger, DEBUG
+from .assets import AssetStore
+from .events import EventBus
+from .write_behind import WriteBehind, WriteTimeout, MISSING
+from .ratelimit import Limiter, MemoryStore, SQLiteStore
+from .replica import Replica, read_counters
 
 ################################
 # Set up app
 APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-app = Flask(
-    __name__,
-    template_folder=os.path.join(APP_PATH, "templates/"),
-    static_folder=os.path.join(APP_PATH, "static/"),
-)
-
-app.config.from_pyfile('secrets')
+# All the routes, hooks and commands; create_app() registers them with the app
+bp = Blueprint("headbook", __name__, cli_group=None)
 
 # Add a login manager to the app
 import flask_login
 from flask_login import current_user, login_required, login_user
 
 login_manager = flask_login.LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = "login"
+login_manager.login_view = "headbook.login"
+
+# Services used by the routes. They're set up by create_app() (so there's one
+# app per process), and nothing here touches the database until it's needed:
+# with a pre-fork server, every worker opens its own connections after the fork.
+db = None           # connection pool
+log = None
+user_cache = None   # hydrated user data by id, shared between requests
+user_ids = None     # user id by username
+hasher = None
+basic_auth_cache = None
+token_cache = None
+fragments = None    # rendered HTML for a user, by (kind, user id)
+assets = None
+events = None       # buddy changes, for /events/ streams
+writes = None       # write-behind queue, if WRITE_BEHIND is on
+limiter = None      # rate limits for logins and buddy changes
+replica = None      # in-memory copy of the database, if REPLICA is on
+
+# Who has added whom, loaded from the buddies table by load_buddy_graph() and
+# kept up to date by User.add_buddy() / User.remove_buddy() and sync_buddy_graph()
+buddy_graph = BuddyGraph()
+buddy_graph_sync = threading.Lock()    # one catch-up at a time
+buddy_graph_reload = threading.Lock()  # one full reload in the background at a time
+
+# (time.monotonic(), the `changes` counters) as last read by current_changes()
+known_changes = (0.0, None)
+
+# the tokens change counter when token_cache was last emptied
+token_cache_counter = None
+
+metrics = Metrics()
+metrics.describe("headbook_request_seconds", "Time spent handling a request, by endpoint")
+metrics.describe("headbook_requests_total", "Requests handled, by endpoint and status")
+metrics.describe("headbook_sql_seconds", "Time to execute an SQL statement (until the first row)")
+metrics.describe("headbook_template_render_seconds", "Time to render a template")
+metrics.describe("headbook_write_batch_seconds", "Time to commit a group of write-behind statements")
+metrics.describe("headbook_writes_total", "Write-behind statements committed, by result")
+metrics.describe("headbook_rejected_total", "Requests turned away with 429, by route class and reason")
+metrics.describe("headbook_replica_reads_total", "Queries that could go to the in-memory replica, by where they went")
+metrics.describe("headbook_replica_refresh_seconds", "Time to copy the database into memory")
+
+
+def create_app(config=None):
+    """Make the Flask app; `config` (a dict) overrides the settings in headbook/secrets.
+
+    Run `flask -A headbook init-db` first, to create or upgrade the database.
+    """
+    global db, log, user_cache, user_ids, hasher, basic_auth_cache, token_cache, assets, events, writes, fragments, limiter, replica
+
+    app = Flask(
+        __name__,
+        template_folder=os.path.join(APP_PATH, "templates/"),
+        static_folder=os.path.join(APP_PATH, "static/"),
+    )
+
+    app.config.from_pyfile('secrets')
+    app.config.update(config or {})
+    app.config.setdefault("DATABASE", "./users.db")
+    app.config.setdefault("DB_POOL_SIZE", 8)         # max open connections per process
+    app.config.setdefault("DB_BUSY_TIMEOUT", 5000)   # ms to wait for a write lock
+    app.config.setdefault("DB_POOL_TIMEOUT", 30)     # s to wait for a free connection
+    app.config.setdefault("USER_CACHE_SIZE", 1024)   # hydrated users kept between requests
+    app.config.setdefault("USER_CACHE_TTL", 30)      # s before a cached user is re-read
+    app.config.setdefault("USERS_PAGE_SIZE", 100)    # default page size for /users/
+    app.config.setdefault("USERS_PAGE_MAX", 1000)    # largest page a client may ask for
+    app.config.setdefault("USERS_BATCH_MAX", 100)    # most profiles in one /users/batch request
+    app.config.setdefault("SEARCH_LIMIT_MAX", 50)    # most results from /users/search
+    app.config.setdefault("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")  # see werkzeug.security
+    app.config.setdefault("PASSWORD_SALT_LENGTH", 16)
+    app.config.setdefault("PASSWORD_HASH_WORKERS", 2)  # processes for hashing; 0 = hash in the request thread
+    app.config.setdefault("PASSWORD_HASH_QUEUE", 32)   # max hashes queued/running before we answer 503
+    app.config.setdefault("RATE_LIMITS", {             # route class -> {"ip"/"user": (requests per s, burst)}
+        "login": {"ip": (1, 30), "user": (0.2, 10)},
+        "buddy": {"ip": (10, 100), "user": (2, 30)},
+    })
+    app.config.setdefault("RATE_LIMIT_STORE", None)    # SQLite file to share the limits between processes; None = per process
+    app.config.setdefault("MAX_IN_FLIGHT", {"login": 8, "buddy": 16})  # concurrent requests per route class and process
+    app.config.setdefault("BASIC_AUTH_CACHE_SIZE", 4096)
+    app.config.setdefault("BASIC_AUTH_CACHE_TTL", 60)  # s before a Basic auth login is re-verified
+    app.config.setdefault("TOKEN_CACHE_SIZE", 16384)
+    app.config.setdefault("TOKEN_CACHE_TTL", 60)       # s to remember who owns a token (forgotten sooner if any token is revoked)
+    app.config.setdefault("FRAGMENT_CACHE_SIZE", 4096) # rendered user cards and profiles
+    app.config.setdefault("FRAGMENT_CACHE_TTL", 300)
+    app.config.setdefault("TEMPLATE_CACHE_DIR", None)  # None = a private directory of this user's; False = compile templates in each process
+    app.config.setdefault("SERVER_TIMING", True)       # add a Server-Timing header to responses
+    app.config.setdefault("METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"])  # who may read /metrics
+    app.config.setdefault("LOG_LEVEL", "DEBUG" if app.debug else "INFO")
+    app.config.setdefault("LOG_SAMPLING", {})          # category -> fraction of records to keep, e.g. {"sql": 0.01}
+    app.config.setdefault("LOG_QUEUE_SIZE", 10000)     # records waiting to be written before we drop some
+    app.config.setdefault("EVENTS_MAX_STREAMS", 8)     # open /events/ streams per process (each takes a thread)
+    app.config.setdefault("EVENTS_POLL_INTERVAL", 5)   # s between checks for changes made by other processes
+    app.config.setdefault("EVENTS_STREAM_TIME", 300)   # s before a stream is closed (browsers reconnect)
+    app.config.setdefault("SESSION_SNAPSHOT", False)   # rebuild the logged in user from the session, not the database
+    app.config.setdefault("CHANGES_MAX_AGE", 0)        # s to reuse the change counters; other processes' changes show up this much later
+    app.config.setdefault("REPLICA", False)            # read users and buddies from a copy of the database in memory
+    app.config.setdefault("REPLICA_MIN_INTERVAL", 0.5) # s between copies, when other processes keep changing things
+    app.config.setdefault("REPLICA_COPIES", 4)         # requests per process that can read from the replica at once
+    app.config.setdefault("WRITE_BEHIND", False)       # queue writes and commit them in groups (see write_behind.py)
+    app.config.setdefault("WRITE_BEHIND_INTERVAL", 0.005)  # s to collect writes before committing them
+    app.config.setdefault("WRITE_BEHIND_BATCH", 500)   # most statements in one transaction
+    app.config.setdefault("WRITE_BEHIND_WAIT", False)  # wait for the commit before answering (durable, still grouped)
+    app.config.setdefault("WRITE_BEHIND_TIMEOUT", 30)  # s to wait for a full queue or a commit before giving up
+
+    # connections are opened on first use, in the process that uses them
+    db = ConnectionPool(
+        app.config["DATABASE"],
+        size=app.config["DB_POOL_SIZE"],
+        busy_timeout=app.config["DB_BUSY_TIMEOUT"],
+        checkout_timeout=app.config["DB_POOL_TIMEOUT"],
+        setup=check_schema,
+    )
+
+    log = Logger(
+        app.config["LOG_LEVEL"],
+        queue_size=app.config["LOG_QUEUE_SIZE"],
+        sampling=app.config["LOG_SAMPLING"],
+        context=log_context,
+    )
+
+    # Entries are plain dicts; every lookup gets its own User copy.
+    user_cache = TTLCache(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+    user_ids = TTLCache(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+
+    hasher = PasswordHasher(
+        app.config["PASSWORD_HASH_METHOD"],
+        app.config["PASSWORD_SALT_LENGTH"],
+        workers=app.config["PASSWORD_HASH_WORKERS"],
+        max_pending=app.config["PASSWORD_HASH_QUEUE"],
+    )
+
+    # Basic auth sends the password with every request; this lets us skip
+    # the (slow) hash check for credentials we verified a moment ago
+    basic_auth_cache = CredentialCache(
+        TTLCache(app.config["BASIC_AUTH_CACHE_SIZE"], app.config["BASIC_AUTH_CACHE_TTL"])
+    )
+
+    # User id by access token digest, for Bearer auth
+    token_cache = TTLCache(app.config["TOKEN_CACHE_SIZE"], app.config["TOKEN_CACHE_TTL"])
+
+    metrics.add_cache("users", user_cache)
+    metrics.add_cache("user_ids", user_ids)
+    # HTML for a user is only reused while their version is the same
+    fragments = TTLCache(app.config["FRAGMENT_CACHE_SIZE"], app.config["FRAGMENT_CACHE_TTL"])
+
+    metrics.add_cache("tokens", token_cache)
+    metrics.add_cache("fragments", fragments)
+    metrics.add_cache("basic_auth", basic_auth_cache.cache)
+
+    events = EventBus(app.config["EVENTS_MAX_STREAMS"])
+
+    # each process makes its own copy, on first use (or in gunicorn's post_worker_init)
+    replica = None
+    if app.config["REPLICA"]:
+        replica = Replica(
+            app.config["DATABASE"],
+            size=app.config["REPLICA_COPIES"],
+            min_interval=app.config["REPLICA_MIN_INTERVAL"],
+            on_refresh=replica_refreshed,
+        )
+
+    store = SQLiteStore(app.config["RATE_LIMIT_STORE"]) if app.config["RATE_LIMIT_STORE"] else MemoryStore()
+    limiter = Limiter(app.config["RATE_LIMITS"], app.config["MAX_IN_FLIGHT"], store)
+
+    # the writer thread starts on first use, in the process that uses it
+    writes = None
+    if app.config["WRITE_BEHIND"]:
+        writes = WriteBehind(
+            db.connect,
+            interval=app.config["WRITE_BEHIND_INTERVAL"],
+            batch_size=app.config["WRITE_BEHIND_BATCH"],
+            wait=app.config["WRITE_BEHIND_WAIT"],
+            timeout=app.config["WRITE_BEHIND_TIMEOUT"],
+            on_commit=writes_committed,
+        )
+
+    # static/ is read into memory (with gzipped copies) once, at startup
+    assets = AssetStore(app.static_folder, file_types)
+    assets.load()
+    app.jinja_env.globals["asset_url"] = assets.url
+
+    # compiled templates are kept on disk, so new workers don't have to compile them again
+    # (anyone who can write to the directory can make us run their code, so don't share it)
+    if app.config["TEMPLATE_CACHE_DIR"] is None:
+        # Jinja's default: a directory in /tmp that only this user can get into, checked on each start
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+    elif app.config["TEMPLATE_CACHE_DIR"]:
+        os.makedirs(app.config["TEMPLATE_CACHE_DIR"], mode=0o700, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["TEMPLATE_CACHE_DIR"])
+
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    app.teardown_appcontext(teardown_db)
+    before_render_template.connect(template_started, app)
+    template_rendered.connect(template_finished, app)
+    return app
 
 ################################
 
-def debug(*args, **kwargs):
-    if request and '_user_id' in session:
-        print(f"[user={session.get('_user_id')}]  ", end='', file=sys.stderr)
-    print(*args, file=sys.stderr, **kwargs)
+def log_context():
+    """Extra fields for log records: who is logged in, if anyone"""
+    if flask.has_request_context() and '_user_id' in session:
+        return {"user": session.get('_user_id')}
+    return {}
+
+def form_fields(form):
+    """Form data that is safe to log"""
+    return {k: v for (k, v) in form.data.items() if "password" not in k and k != "csrf_token"}
+
+def publish_buddy_change(a, b):
+    """Tell both users' /events/ streams (in this process) that their relation has changed"""
+    events.publish(a, b)
+    events.publish(b, a)
+
+def sql_write(stmt, params, overlay=()):
+    """Execute a statement that changes the database, or queue it if WRITE_BEHIND is on.
+
+    `overlay` is what readers in this process should see until it has been committed
+    (see WriteBehind.submit()); without write-behind, the change is visible at once.
+    """
+    if writes:
+        writes.submit(stmt, params, overlay)
+    elif replica:
+        replicated_write(stmt, params)
+    else:
+        sql_execute(stmt, params)
+
+def replicated_write(stmt, params):
+    """Execute a statement that changes the database, and then on the replica (REPLICA)"""
+    # in one transaction, for the counters as our write left them, before anyone else's;
+    # on the request's cursor, which drops any unfinished read first
+    cursor = get_cursor()
+    cursor.execute("BEGIN IMMEDIATE;")
+    try:
+        sql_execute(stmt, params)
+        counters = read_counters(cursor)
+        cursor.execute("COMMIT;")
+    except BaseException:
+        if get_db().in_transaction:
+            cursor.execute("ROLLBACK;")
+        raise
+    replica.apply([(stmt, params)], counters)
+
+def writes_committed(flush):
+    """Called by the write-behind thread after each group of statements"""
+    metrics.observe("headbook_write_batch_seconds", flush.seconds)
+    metrics.inc("headbook_writes_total", len(flush.items) - len(flush.failures), result="ok")
+    if replica and flush.after:
+        failed = {item.seq for (item, _) in flush.failures}
+        replica.apply([(item.stmt, item.params) for item in flush.items if item.seq not in failed], flush.after)
+    buddies_failed = False
+    for (item, e) in flush.failures:
+        metrics.inc("headbook_writes_total", result="error")
+        log.error("db", "write-behind statement failed: %s %s", sql_label(item.stmt), e)
+        for (key, _) in item.overlay:
+            if key[0] == "user":
+                user_cache.pop(key[1])
+            elif key[0] == "token":
+                token_cache.pop(key[1])
+            elif key[0] == "buddy":
+                buddies_failed = True
+    if buddies_failed:
+        # the graph has a change the database doesn't; reload it
+        buddy_graph.version = None
+    elif "buddies" in flush.after:
+        buddy_graph.advance(flush.after["buddies"], since=flush.before["buddies"])
+
+def invalidate_user(user_id):
+    """Forget any cached copies of a user after it has been changed"""
+    user_cache.pop(user_id)
+    for kind in FRAGMENT_KINDS:
+        fragments.pop((kind, user_id))
+    users = g.get("users")
+    if users:
+        for key in [k for k, u in users.items() if u.id == user_id]:
+            del users[key]
+
+FRAGMENT_KINDS = ["card", "profile"]
+
+def cached_fragment(kind, user_id, version, render):
+    """HTML for a user (a "card" or "profile"), rendered by `render()` unless we have it for this version"""
+    entry = fragments.get((kind, user_id))
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    html = Markup(render())
+    fragments.set((kind, user_id), (version, html))
+    return html
+
+# columns of the users table that User.save() writes (besides `info`, which holds the rest)
+USER_COLUMNS = ["username", "password", *PROFILE_COLUMNS]
+# the columns of the rows that User.user_data_from_row() takes
+ROW_COLUMNS = ["id", "username", "password", "info", "version", *PROFILE_COLUMNS]
+NOT_INFO = {"id", "buddies", "version", *USER_COLUMNS}
+
+def is_user_id(userid):
+    """True for a user id, False for a username (str.isnumeric() also accepts '²', which int() doesn't)"""
+    return userid.isascii() and userid.isdigit()
 
 def prefers_json():
     return request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json'
@@ -61,39 +361,62 @@ def prefers_json():
 class User(flask_login.UserMixin, Box):
     def __init__(self, user_data):
         super().__init__(user_data)
+        # what's in the database, so save() can write just the changes
+        object.__setattr__(self, "_saved", dict(user_data))
 
     def save(self):
-        """Save this user object to the database"""
-        info = json.dumps({k: self[k] for k in self if k not in ["username", "password", "id"]})
+        """Save this user object to the database, writing only the fields that have changed"""
+        info = {k: v for (k, v) in self.items() if k not in NOT_INFO}
         if "id" in self:
-            sql = "UPDATE users SET username=:username, password=:password, info=:info WHERE id=:id;"
-            params = {"username": self.username, "password": self.password, "info": info, "id": self.id}
+            saved = self._saved
+            params = {k: self.get(k) for k in USER_COLUMNS if self.get(k) != saved.get(k)}
+            if info != {k: v for (k, v) in saved.items() if k not in NOT_INFO}:
+                params["info"] = json.dumps(info)
+            if not params:
+                return
+            # only the columns in `params`, so the statement varies; it's always a primary key lookup
+            sql = f"UPDATE users SET {', '.join(f'{k}=:{k}' for k in params)} WHERE id=:id;"
+            sql_write(sql, {**params, "id": self.id}, [(("user", self.id), params)])
         else:
-            sql = "INSERT INTO users (username, password, info) VALUES (:username, :password, :info);"
-            params = {"username": self.username, "password": self.password, "info": info}
-
-        sql_execute(sql, params)
-        if "id" not in self:
-            self.id = db.session.execute("SELECT last_insert_rowid()").scalar()
+            sql = """INSERT INTO users (username, password, info, color, birthdate, picture_url, about)
+                VALUES (:username, :password, :info, :color, :birthdate, :picture_url, :about);"""
+            params = {k: self.get(k) for k in USER_COLUMNS}
+            params["info"] = json.dumps(info)
+            # not queued, since we need the new id
+            if replica:
+                replicated_write(sql, params)
+            else:
+                sql_execute(sql, params)
+            self.id = get_db().last_insert_rowid()
+        object.__setattr__(self, "_saved", {k: v for (k, v) in self.items() if k != "buddies"})
+        invalidate_user(self.id)
 
     def add_token(self, name=""):
-        """Add a new access token for a user"""
+        """Add a new access token for a user, and return it.
+
+        Only a digest of the token is stored, so this is the only chance to see it.
+        """
         token = secrets.token_urlsafe(32)
-        sql = "INSERT INTO tokens (user_id, token, name) VALUES (:user_id, :token, :name);"
-        params = {"user_id": self.id, "token": token, "name": name}
+        sql = "INSERT INTO tokens (user_id, token_hash, name) VALUES (:user_id, :token_hash, :name);"
+        params = {"user_id": self.id, "token_hash": hash_token(token), "name": name}
 
-        sql_execute(sql, params)
+        sql_write(sql, params, [(("token", params["token_hash"]), self.id)])
+        invalidate_user(self.id)
+        return token
 
     def delete_token(self, token):
         """Delete an access token"""
-        sql = "DELETE FROM tokens WHERE user_id = :user_id AND token = :token;"
-        params = {"user_id": self.id, "token": token}
+        token_hash = hash_token(token)
+        sql = "DELETE FROM tokens WHERE user_id = :user_id AND token_hash = :token_hash;"
+        params = {"user_id": self.id, "token_hash": token_hash}
 
-        sql_execute(sql, params)
+        sql_write(sql, params, [(("token", token_hash), None)])
+        token_cache.pop(token_hash)
+        invalidate_user(self.id)
 
     def get_tokens(self):
-        """Retrieve all access tokens belonging to a user"""
-        sql = "SELECT token, name FROM tokens WHERE user_id = :user_id;"
+        """Retrieve (hex digest, name) of all access tokens belonging to a user"""
+        sql = "SELECT lower(hex(token_hash)), name FROM tokens WHERE user_id = :user_id;"
         params = {"user_id": self.id}
 
         return sql_execute(sql, params).fetchall()
@@ -102,63 +425,186 @@ class User(flask_login.UserMixin, Box):
         """Add a user as a buddy"""
         sql = "INSERT INTO buddies (user1_id, user2_id) VALUES (:us, :them)"
         params = {"us": self.id, "them" : other_user.id}
-        sql_execute(sql, params)
+        sql_write(sql, params, [(("buddy", self.id, other_user.id), True)])
+        buddy_graph.add(self.id, other_user.id)
+        if not writes:
+            buddy_graph.advance(change_counter("buddies"))
+        invalidate_user(self.id)
+        publish_buddy_change(self.id, other_user.id)
         
     def remove_buddy(self, other_user):
         """Remove a user as a buddy"""
         sql = "DELETE FROM buddies WHERE user1_id = :us AND user2_id = :them;"
         params = {"us": self.id, "them" : other_user.id}
-        sql_execute(sql, params)
+        sql_write(sql, params, [(("buddy", self.id, other_user.id), False)])
+        buddy_graph.remove(self.id, other_user.id)
+        if not writes:
+            buddy_graph.advance(change_counter("buddies"))
+        invalidate_user(self.id)
+        publish_buddy_change(self.id, other_user.id)
     
     def buddy_status(self, other_user):
-        if self.id == other_user.id:
-            return -1
-        elif not other_user.id in self.buddies and not self.id in other_user.buddies:
-            return 0
-        elif other_user.id in self.buddies and not self.id in other_user.buddies:
-            return 1
-        elif not other_user.id in self.buddies and self.id in other_user.buddies:
-            return 2
-        elif other_user.id in self.buddies and self.id in other_user.buddies:
-            return 3
+        """-1 = self, 0 = no relation, 1 = we've sent them a request, 2 = they've sent us a request, 3 = buddies"""
+        return buddy_graph.status(self.id, other_user.id)
     
     @staticmethod
     def get_buddies_list(user_id):
-        sql = "SELECT user2_id FROM buddies WHERE user1_id = :user_id;"
-        params = {"user_id": user_id}
-        buddy_results = sql_execute(sql, params).fetchall()
-        return [buddy[0] for buddy in buddy_results]
+        return buddy_graph.buddies(user_id)
+
+    @staticmethod
+    def get_usernames(user_ids):
+        """Get [{id, username}, ...] for the given user ids, in the same order"""
+        # CROSS JOIN makes SQLite look up each id, rather than scan users and check the list
+        sql = "SELECT u.id, u.username FROM json_each(:ids) j CROSS JOIN users u ON u.id = j.value;"
+        names = dict(sql_read(sql, {"ids": json.dumps(list(user_ids))}).fetchall())
+        return [{"id": i, "username": names[i]} for i in user_ids if i in names]
     
     
     @staticmethod
     def get_token_user(token):
         """Retrieve the user who owns a particular access token"""
-        sql = "SELECT user_id FROM tokens WHERE token = :token;"
-        params = {"token": token}
-        user_id = sql_execute(sql, params).scalar()
+        token_hash = hash_token(token)
+        user_id = writes.pending(("token", token_hash), MISSING) if writes else MISSING
+        if user_id is None:
+            return None  # deleted, but not committed yet
+        if user_id is MISSING:
+            check_token_cache()
+            user_id = token_cache.get(token_hash)
         if user_id is not None:
             return User.get_user(user_id)
+
+        sql = """SELECT u.id, u.username, u.password, u.info, u.version, u.color, u.birthdate, u.picture_url, u.about
+            FROM tokens t JOIN users u ON u.id = t.user_id
+            WHERE t.token_hash = :token_hash;"""
+        row = sql_execute(sql, {"token_hash": token_hash}).fetchone()
+        if row:
+            data = User.user_data_from_row(row)
+            User.cache_user_data(data)
+            token_cache.set(token_hash, data["id"])
+            return User.from_user_data(data)
     
     @staticmethod
     def get_user(userid):
+        """Look up a user by id or username, going through the user caches"""
+        userid = str(userid)
         if not userid.isalnum():
             return None
+        key = int(userid) if is_user_id(userid) else userid
+
+        # within a request, every lookup of the same user gives the same object
+        users = g.setdefault("users", {})
+        if key in users:
+            return users[key]
+
+        user_id = key if isinstance(key, int) else user_ids.get(key)
+        data = user_cache.get(user_id) if user_id is not None else None
+        if data is None:
+            data = User.load_user_data(userid)
+            if data is None:
+                return None
+            User.cache_user_data(data)
 
-        if userid.isnumeric():
-            sql = "SELECT id, username, password, info FROM users WHERE id = :userid;"
+        return User.from_user_data(data)
+
+    @staticmethod
+    def get_fresh_user(userid):
+        """Like get_user(), but never a cached copy older than the database.
+
+        For checking passwords: another process may have changed the password
+        since we cached the user, and only invalidated its own cache.
+        """
+        u = User.get_user(userid)
+        if u and u.version != User.get_version(str(u.id)):
+            invalidate_user(u.id)
+            u = User.get_user(u.id)
+        return u
+
+    @staticmethod
+    def get_users(user_ids):
+        """Look up several users by id at once; returns a dict of id -> User for the ones that exist"""
+        users = g.setdefault("users", {})
+        result = {}
+        missing = []
+        for user_id in user_ids:
+            if user_id in users:
+                result[user_id] = users[user_id]
+            else:
+                data = user_cache.get(user_id)
+                if data is None:
+                    missing.append(user_id)
+                else:
+                    result[user_id] = User.from_user_data(data)
+
+        if missing:
+            # one query for all the users we don't already have
+            sql = """SELECT u.id, u.username, u.password, u.info, u.version, u.color, u.birthdate, u.picture_url, u.about
+                FROM json_each(:ids) j CROSS JOIN users u ON u.id = j.value;"""
+            for row in sql_read(sql, {"ids": json.dumps(missing)}).fetchall():
+                data = User.user_data_from_row(row)
+                User.cache_user_data(data)
+                result[data["id"]] = User.from_user_data(data)
+
+        return result
+
+    @staticmethod
+    def from_user_data(data):
+        """Make a User from (cached) user data, and remember it for the rest of the request"""
+        user = User(copy.deepcopy(data))
+        user.buddies = User.get_buddies_list(user.id)
+        users = g.setdefault("users", {})
+        users[user.id] = users[user.username] = user
+        return user
+
+    @staticmethod
+    def cache_user_data(data):
+        user_cache.set(data["id"], data)
+        user_ids.set(data["username"], data["id"])
+
+    @staticmethod
+    def user_data_from_row(row):
+        """Turn an (id, username, password, info, version, <PROFILE_COLUMNS>) row into user data.
+
+        Empty profile fields are left out, like missing keys in `info`.
+        """
+        pending = writes.pending(("user", row[0])) if writes else None
+        if pending:
+            # saved by this process, but not committed yet
+            row = [pending.get(col, value) for (col, value) in zip(ROW_COLUMNS, row)]
+        user_data = json.loads(row[3]) if row[3] != "{}" else {}  # most users have no extra fields
+        user_data.update({"id": row[0], "username": row[1], "password": row[2], "version": row[4]})
+        user_data.update({k: v for (k, v) in zip(PROFILE_COLUMNS, row[5:]) if v is not None})
+        return user_data
+
+    @staticmethod
+    def get_version(userid):
+        """The current version of a user (by id or username), without loading them"""
+        if is_user_id(userid):
+            sql = "SELECT version FROM users WHERE id = :userid;"
         else:
-            sql = "SELECT id, username, password, info FROM users WHERE username = :username;"
+            sql = "SELECT version FROM users WHERE username = :userid;"
+        row = sql_read(sql, {"userid": userid}).fetchone()
+        return row[0] if row else None
+
+    def public_profile(self):
+        """The user's data without anything private or internal"""
+        return {k: self[k] for k in self if k not in ["password", "version"]}
+
+    @staticmethod
+    def load_user_data(userid):
+        """Read a user from the database, bypassing the caches"""
+        if is_user_id(userid):
+            sql = """SELECT id, username, password, info, version, color, birthdate, picture_url, about
+                FROM users WHERE id = :userid;"""
+        else:
+            sql = """SELECT id, username, password, info, version, color, birthdate, picture_url, about
+                FROM users WHERE username = :username;"""
 
 
         params = {"userid": userid, "username": userid}
-        result = sql_execute(sql, params).fetchone()
+        result = sql_read(sql, params).fetchone()
 
         if result:
-            user_data = json.loads(result[3])
-            user = User(user_data)
-            user.update({"id": result[0], "username": result[1], "password": result[2]})
-            user.buddies = User.get_buddies_list(user.id)
-            return user
+            return User.user_data_from_row(result)
 
 
 # This method is called whenever the login manager needs to get
@@ -166,9 +612,51 @@ class User(flask_login.UserMixin, Box):
 # the id of a logged in user in the session data (session['_user_id'])
 @login_manager.user_loader
 def user_loader(user_id):
+    if current_app.config["SESSION_SNAPSHOT"]:
+        return snapshot_user(user_id)
     return User.get_user(user_id)
 
 
+def snapshot_user(user_id):
+    """The logged in user, rebuilt from the snapshot in the session while that is current.
+
+    The snapshot is [id, username, version, users change counter]. While no user
+    has changed since it was taken, it's current without looking at the database;
+    otherwise we look up this user's version, and load them again only if it has
+    moved on. The session cookie is signed, so clients can't forge a snapshot.
+    """
+    counter = current_changes()["users"]
+    snapshot = session.get("user_snapshot")
+    db_version = None
+    if snapshot and str(snapshot[0]) == user_id:
+        (uid, username, version, seen) = snapshot
+        if seen != counter:
+            db_version = User.get_version(user_id)
+        if seen == counter or db_version == version:
+            if seen != counter:
+                session["user_snapshot"] = [uid, username, version, counter]
+            # only what identifies the user; pages that need the rest use User.get_user()
+            user = User({"id": uid, "username": username, "version": version})
+            user.buddies = User.get_buddies_list(uid)
+            return user
+
+    user = User.get_user(user_id)
+    if user and user.version != (db_version or User.get_version(user_id)):
+        # our cached copy is older than the database
+        invalidate_user(user.id)
+        user = User.get_user(user_id)
+    if user:
+        remember_snapshot(user, counter)
+    return user
+
+
+def remember_snapshot(user, counter=None):
+    """Put a snapshot of `user` in the session (see snapshot_user())"""
+    if counter is None:
+        counter = current_changes()["users"]
+    session["user_snapshot"] = [user.id, user.username, user.version, counter]
+
+
 # This method is called to get a User object based on a request,
 # for example, if using an api key or authentication token rather
 # than getting the user name the standard way (from the session cookie)
@@ -192,17 +680,19 @@ def request_loader(request):
             .decode(errors="ignore")
             .split(":", maxsplit=1)
         )
-        debug(f"Basic auth: {uname}:{passwd}")
-        u = User.get_user(uname)
-        if u and u.password == passwd:
+        log.debug("auth", "Basic auth: %s", uname)
+        u = User.get_fresh_user(uname)
+        if u and check_basic_auth(u, passwd):
             return u
     elif auth_scheme == "bearer":  # Bearer auth contains an access token;
         # an 'access token' is a unique string that both identifies
         # and authenticates a user, so no username is provided (unless
         # you encode it in the token – see JWT (JSON Web Token), which
         # encodes credentials and (possibly) authorization info)
-        debug(f"Bearer auth: {auth_params}")
-        # TODO
+        log.debug("auth", "Bearer auth")
+        u = User.get_token_user(auth_params)
+        if u:
+            return u
     # For other authentication schemes, see
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Authentication
 
@@ -219,6 +709,45 @@ def request_loader(request):
         www_authenticate=WWWAuthenticate("Basic realm=headbook, Bearer"),
     )
 
+def check_basic_auth(user, password):
+    """Check a Basic auth password, using the cache of recently verified credentials"""
+    if basic_auth_cache.verified(user.username, password, user.password):
+        return True
+    if hasher.check(user.password, password):
+        basic_auth_cache.remember(user.username, password, user.password)
+        return True
+    return False
+
+
+# route class of the (POST) endpoints that are rate limited; see RATE_LIMITS
+RATE_LIMITED = {"headbook.login": "login", "headbook.add_buddy": "buddy", "headbook.remove_buddy": "buddy"}
+
+def claimed_user():
+    """Whose "user" bucket a request takes from, before we check who it's from: for a login,
+    the account being logged in to (to slow down password guessing); otherwise the logged
+    in user's id from the signed session, or a digest of the Bearer token. Not the Basic
+    auth username – anyone can send that, and would use up the named user's bucket."""
+    if request.endpoint == "headbook.login":
+        return request.form.get("username")
+    if "_user_id" in session:
+        return session["_user_id"]
+    auth = request.authorization
+    if auth and auth.type == "bearer" and auth.token:
+        return hash_token(auth.token).hex()[:32]
+    return None
+
+@bp.app_errorhandler(HashingBusy)
+def hashing_busy(e):
+    """Too many logins/password changes in progress – ask the client to come back later"""
+    return "Server busy, please try again.", HTTPStatus.SERVICE_UNAVAILABLE, {"Retry-After": "1"}
+
+@bp.app_errorhandler(WriteTimeout)
+def writes_busy(e):
+    """The write-behind queue isn't keeping up (WRITE_BEHIND) – ask the client to come back later"""
+    log.error("db", "write-behind: %s", e)
+    return "Server busy, please try again.", HTTPStatus.SERVICE_UNAVAILABLE, {"Retry-After": "1"}
+
+
 ################################
 # ROUTES – these get called to handle requests
 #
@@ -232,159 +761,465 @@ def request_loader(request):
 #      * current_user – a User object with the currently logged in user (if any)
 
 
-@app.get("/")
-@app.get("/index.html")
+@bp.get("/")
+@bp.get("/index.html")
 @login_required
 def index_html():
-    """Render the home page"""
-
-    return render_template("home.html")
+    """Render the home page, with the first page of user cards already in it"""
+    # the same until a user is added, changed or deleted
+    counter = current_changes()["users"]
+    page = fragments.get("home")
+    if page is None or page[0] != counter:
+        (rows, next_after) = users_page(0, current_app.config["USERS_PAGE_SIZE"])
+        cards = [
+            cached_fragment("card", user_id, version, lambda: render_template("_card.html", user={"id": user_id, "username": username}))
+            for (user_id, username, version) in rows
+        ]
+        page = (counter, (cards, next_after))
+        fragments.set("home", page)
+    (cards, next_after) = page[1]
+    return render_template("home.html", cards=cards, next_after=next_after)
+
+
+# browsers can be really picky about file types, so it's important 
+# to set this correctly, particularly for JS and CSS
+file_types = {
+    "js": "application/javascript",
+    "ico": "image/vnd.microsoft.icon",
+    "png": "image/png",
+    "html": "text/html",
+    "css": "text/css",
+}
+
+
+@bp.get("/<filename>.<ext>")  # by default, path parameters (filename, ext) match any string not including a '/'
+def serve_static(filename, ext):
+    """Serve files from the static/ subdirectory.
 
+    Fingerprinted URLs (`/script.<hash>.js`, see asset_url() in templates) are cached
+    by browsers for a year; plain URLs must be revalidated (cheap, thanks to the ETag).
+    """
+    (asset, fingerprinted) = assets.lookup(filename, ext)
+    if not asset:
+        abort(404)
 
-@app.get("/<filename>.<ext>")  # by default, path parameters (filename, ext) match any string not including a '/'
-def serve_static(filename, ext):
-    """Serve files from the static/ subdirectory"""
-
-    # browsers can be really picky about file types, so it's important 
-    # to set this correctly, particularly for JS and CSS
-    file_types = {
-        "js": "application/javascript",
-        "ico": "image/vnd.microsoft.icon",
-        "png": "image/png",
-        "html": "text/html",
-        "css": "text/css",
+    use_gzip = asset.gzip is not None and request.accept_encodings["gzip"] > 0
+    etag = asset.digest + ("-gz" if use_gzip else "")
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable" if fingerprinted else "no-cache",
+        "Vary": "Accept-Encoding",
     }
-
-    if ext in file_types:
-        return send_from_directory(
-            app.static_folder, f"{filename}.{ext}", mimetype=file_types[ext]
-        )
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=HTTPStatus.NOT_MODIFIED, headers=headers)
     else:
-        abort(404)
+        response = current_app.response_class(asset.gzip if use_gzip else asset.body, mimetype=asset.mimetype, headers=headers)
+        if use_gzip:
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(etag)
+    return response
 
 
-@app.route("/login/", methods=["GET", "POST"])
+@bp.route("/login/", methods=["GET", "POST"])
 def login():
     """Render (GET) or process (POST) login form"""
 
-    debug('/login/ – session:', session, request.host_url)
+    if log.enabled(DEBUG, "http"):
+        log.emit(DEBUG, "http", "/login/ %s", request.host_url)
     form = LoginForm()
 
     if not form.next.data:
         form.next.data = flask.request.args.get("next") # set 'next' field from URL parameters
 
     if form.is_submitted():
-        debug(
-            f'Received form:\n    {form.data}\n{"INVALID" if not form.validate() else "valid"} {form.errors}'
-        )
+        if log.enabled(DEBUG, "forms"):
+            log.emit(DEBUG, "forms", "Received login form %s: %s", form_fields(form), form.validate() and "valid" or form.errors)
         if form.validate():
             username = form.username.data
             password = form.password.data
-            user = user_loader(username)
+            user = User.get_fresh_user(username)
             
-            if (user and check_password_hash(user.password, password)):
+            if (user and hasher.check(user.password, password)):
+                if hasher.needs_rehash(user.password):
+                    # hash parameters have changed since the password was set
+                    user.password = hasher.hash(password)
+                    user.save()
+
                 # automatically sets logged in session cookie
                 login_user(user)
+                if current_app.config["SESSION_SNAPSHOT"]:
+                    remember_snapshot(user)
 
                 flask.flash(f"User {user.username} Logged in successfully.")
 
                 return safe_redirect_next()
     return render_template("login.html", form=form)
 
-@app.get('/logout/')
+@bp.get('/logout/')
 def logout_gitlab():
-    print('logout', session, session.get('access_token'))
+    log.info("auth", "logout")
     flask_login.logout_user()
+    session.pop("user_snapshot", None)
     return redirect('/')
 
-@app.route("/profile/", methods=["GET", "POST", "PUT"])
+@bp.route("/profile/", methods=["GET", "POST", "PUT"])
 @login_required
 def my_profile():
     """Display or edit user's profile info"""
-    debug("/profile/ – current user:", current_user, request.host_url)
+    if log.enabled(DEBUG, "http"):
+        log.emit(DEBUG, "http", "/profile/ %s", request.host_url)
 
+    # the full user (current_user may be a snapshot, see SESSION_SNAPSHOT)
+    user = User.get_user(current_user.id)
     form = ProfileForm()
     if form.is_submitted():
-        debug(
-            f'Received form:\n    {form.data}\n    {f"INVALID: {form.errors}" if not form.validate() else "ok"}'
-        )
+        if log.enabled(DEBUG, "forms"):
+            log.emit(DEBUG, "forms", "Received profile form %s: %s", form_fields(form), form.validate() and "ok" or form.errors)
         if form.validate():
             if form.password.data: # change password if user set it
                 if password_constraint_check(form.password.data):
-                    current_user.password = generate_password_hash(form.password.data)
+                    user.password = hasher.hash(form.password.data)
                     flask.flash("Password was successfully updated!")
                 else:
                     flask.flash(f"Password is not strong enough! It needs to be at least six characters and contain a capital letter, a special character, and a number.")
                     
             if form.birthdate.data: # change birthday if set
-                current_user.birthdate = form.birthdate.data.isoformat()
+                user.birthdate = form.birthdate.data.isoformat()
             
             if color_constraint_check(form.color.data):
-                current_user.color = form.color.data
+                user.color = form.color.data
             else:
                 flask.flash('Invalid color selected. For now you can only choose between:\n ["red", "blue", "green", "purple", "black", "orange", "pink", "purple", "cyan", "white"]')
             
             if imageurl_constraint_check(form.picture_url.data):
-                current_user.picture_url = form.picture_url.data
+                user.picture_url = form.picture_url.data
             else:
                 flask.flash("Invalid image link supplied.")
             
-            current_user.about = form.about.data
-            current_user.save()
+            user.about = form.about.data
+            user.save()
         else:
             pass  # The profile.html template will display any errors in form.errors
     else: # fill in the form with the user's info
-        form.username.data = current_user.username
+        form.username.data = user.username
         form.password.data = ""
         form.password_again.data = ""
         # only set this if we have a valid date
-        form.birthdate.data = current_user.get("birthdate") and date.fromisoformat(
-            current_user.get("birthdate")
+        form.birthdate.data = user.get("birthdate") and date.fromisoformat(
+            user.get("birthdate")
         )
-        form.color.data = current_user.get("color", "")
-        form.picture_url.data = current_user.get("picture_url", "")
-        form.about.data = current_user.get("about", "")
+        form.color.data = user.get("color", "")
+        form.picture_url.data = user.get("picture_url", "")
+        form.about.data = user.get("about", "")
 
-    return render_template("profile.html", form=form, user=current_user)
+    return render_template("profile.html", form=form, user=user)
 
 
-@app.get("/users/")
+@bp.get("/users/")
 @login_required
 def get_users():
-    rows = sql_execute("SELECT id, username FROM users;").fetchall()
-
-    result = []
-    for row in rows:
-        user = User({"id": row[0], "username": row[1]})
-        result.append(user)
+    """List users, one page at a time.
+
+    Pages are keyed on user id: `?after=<id>&limit=<n>` returns the next `n` users with
+    an id greater than `after`, and the JSON response includes the `next` cursor (or null
+    on the last page). With `?stream=ndjson` (or `Accept: application/x-ndjson`) or
+    `?stream=json`, all users after the cursor are streamed straight from the database.
+    """
+    after = request.args.get("after", 0, type=int)
+    limit = request.args.get("limit", type=int)
+
+    stream = request.args.get("stream")
+    if not stream and request.accept_mimetypes.best == "application/x-ndjson":
+        stream = "ndjson"
+    if stream in ("ndjson", "json"):
+        return stream_users(after, limit, stream)
+
+    limit = max(1, min(limit or current_app.config["USERS_PAGE_SIZE"], current_app.config["USERS_PAGE_MAX"]))
+    etag = f"l{change_counter('users')}.{after}.{limit}.{'j' if prefers_json() else 'h'}"
+    if request.if_none_match.contains(etag):
+        return conditional_response(None, etag, HTTPStatus.NOT_MODIFIED)
+    (rows, next_after) = users_page(after, limit)
+    result = [User({"id": user_id, "username": username}) for (user_id, username, _) in rows]
 
     if prefers_json():
-        return jsonify(result)
+        return conditional_response(jsonify({"users": result, "next": next_after}), etag)
     else:
-        return render_template("users.html", users=result)
+        return conditional_response(render_template("users.html", users=result), etag)
+
+
+def users_page(after, limit):
+    """(id, username, version) of up to `limit` users with id > after, and the cursor for the next page (or None)"""
+    # fetch one extra row to find out if there is another page
+    rows = sql_read(
+        "SELECT id, username, version FROM users WHERE id > :after ORDER BY id LIMIT :limit;",
+        {"after": after, "limit": limit + 1},
+    ).fetchall()
+    next_after = rows[limit - 1][0] if len(rows) > limit else None
+    return (rows[:limit], next_after)
+
+
+def stream_users(after, limit, fmt):
+    """Stream users with id > after as NDJSON lines or as one JSON document"""
+    sql = "SELECT id, username FROM users WHERE id > :after ORDER BY id LIMIT :limit;"
+    limited = bool(limit and limit > 0)
+    # fetch one extra row to find out if there is another page
+    params = {"after": after, "limit": limit + 1 if limited else -1}
+
+    def generate():
+        # use our own cursor, so other queries in this request don't reset it
+        cursor = get_db().cursor()
+        try:
+            last_id = None
+            more = False
+            if fmt == "json":
+                yield '{"users": ['
+            for (count, (user_id, username)) in enumerate(cursor.execute(sql, params)):
+                if limited and count == limit:
+                    more = True
+                    break
+                item = json.dumps({"id": user_id, "username": username})
+                if fmt == "ndjson":
+                    yield item + "\n"
+                else:
+                    yield item if last_id is None else ", " + item
+                last_id = user_id
+            if fmt == "json":
+                yield f'], "next": {json.dumps(last_id if more else None)}}}\n'
+        finally:
+            cursor.close()
 
+    mimetype = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+    return current_app.response_class(stream_with_context(generate()), mimetype=mimetype)
 
-@app.get("/users/<userid>")
+
+@bp.get("/users/<userid>")
 @login_required
 def get_user(userid):
     if userid == 'me':
-        u = current_user
-    else:
+        userid = str(current_user.id)
+    if not userid.isalnum():
+        abort(404)
+
+    # the response depends on the user's row and buddy list (covered by the version),
+    # who's asking (access control) and the format
+    version = User.get_version(userid)
+    if version is None:
+        abort(404)
+    etag = f"u{userid}.{version}.{current_user.id}.{'j' if prefers_json() else 'h'}"
+    if writes and writes.busy():
+        # the version doesn't count changes that are still queued
+        etag += f".p{writes.seq}"
+    if request.if_none_match.contains(etag):
+        return conditional_response(None, etag, HTTPStatus.NOT_MODIFIED)
+
+    u = User.get_user(userid)
+    if u and u.version != version:
+        # our cached copy is older than the database
+        invalidate_user(u.id)
         u = User.get_user(userid)
     
     if u:
-        del u["password"] # hide the password, just in case
-        if u == current_user or (current_user.buddy_status(u) >= 2):
+        if u.id == current_user.id or (current_user.buddy_status(u) >= 2):
+            profile = u.public_profile() # hide the password, just in case
             if prefers_json():
-                return jsonify(u)
+                return conditional_response(jsonify(profile), etag)
             else:
-                return render_template("users.html", users=[u])
+                # their buddy list also changes when someone else adds or removes them
+                html = cached_fragment("profile", u.id, (u.version, tuple(u.buddies)), lambda: render_template("users.html", users=[profile]))
+                return conditional_response(html, etag)
         else:
             return "You don't have access to this user's page."
     else:
         abort(404)
 
-@app.route('/add_buddy/<adding_user_id>/<added_user_id>/', methods=['POST'])
+
+def conditional_response(rv, etag, status=None):
+    """Make a response with an ETag that the browser must revalidate before reusing"""
+    response = make_response(rv) if rv is not None else current_app.response_class(status=status)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.update(["Accept", "Cookie"])
+    return response
+
+
+def change_counter(name):
+    """How many times the 'users' or 'buddies' table has been changed"""
+    return sql_execute("SELECT counter FROM changes WHERE name = :name;", {"name": name}).fetchone()[0]
+
+def current_changes():
+    """The change counters, read once per request – or, with CHANGES_MAX_AGE, at most that often per process"""
+    global known_changes
+    if "changes" not in g:
+        (read_at, counters) = known_changes
+        if counters is None or time.monotonic() - read_at >= current_app.config["CHANGES_MAX_AGE"]:
+            sql = "SELECT name, counter FROM changes WHERE name IN ('users', 'buddies', 'tokens');"
+            counters = dict(sql_execute(sql).fetchall())
+            known_changes = (time.monotonic(), counters)
+        g.changes = counters
+    return g.changes
+
+def check_token_cache():
+    """Forget who owns which token if any token has been deleted or changed since we last
+    looked, e.g. revoked in another worker process"""
+    global token_cache_counter
+    counter = current_changes()["tokens"]
+    if counter != token_cache_counter:
+        token_cache.clear()
+        token_cache_counter = counter
+
+@bp.get("/users/search")
+@login_required
+def search_users():
+    """Find users by (the beginning of) words in their username or 'about' text.
+
+    `?q=ali` matches "alice"; with several words, all must match. Results are ranked,
+    username matches first. Matches in 'about' only count for users whose profile
+    you can see.
+    """
+    words = re.findall(r"\w+", request.args.get("q", "").lower())[:8]
+    limit = max(1, min(request.args.get("limit", 10, type=int), current_app.config["SEARCH_LIMIT_MAX"]))
+    if not words:
+        return jsonify({"users": []})
+
+    # every word is a quoted prefix query, so user input can't inject FTS syntax
+    query = " ".join(f'"{w}"*' for w in words)
+    sql = """SELECT u.id, u.username
+        FROM users_fts f JOIN users u ON u.id = f.rowid
+        WHERE users_fts MATCH :query
+        ORDER BY bm25(users_fts, 10.0, 1.0)
+        LIMIT :limit OFFSET :offset;"""
+
+    result = []
+    # fetch extra rows, since some may be dropped below, and more until the page is full
+    # or there are no more matches
+    (offset, batch) = (0, limit * 4)
+    while len(result) < limit:
+        rows = sql_execute(sql, {"query": query, "limit": batch, "offset": offset}).fetchall()
+        for (user_id, username) in rows:
+            status = buddy_graph.status(current_user.id, user_id)
+            if not (status == -1 or status >= 2):
+                # only the username is public, so it must match by itself
+                name_words = re.findall(r"\w+", username.lower())
+                if not all(any(n.startswith(w) for n in name_words) for w in words):
+                    continue
+            result.append({"id": user_id, "username": username})
+            if len(result) == limit:
+                break
+        if len(rows) < batch:
+            break
+        (offset, batch) = (offset + batch, batch * 2)
+
+    return jsonify({"users": result})
+
+
+@bp.get("/users/batch")
+@login_required
+def get_users_batch():
+    """Get several profiles at once, e.g. `/users/batch?ids=1,2,3`.
+
+    Each profile comes with its `buddy_status` relative to the current user. As with
+    `/users/<userid>`, only id, username and buddy status are shown unless the
+    user is you or has added you as a buddy.
+    """
+    try:
+        ids = [int(i) for i in request.args.get("ids", "").split(",") if i.strip()]
+    except ValueError:
+        abort(400)
+    if len(ids) > current_app.config["USERS_BATCH_MAX"]:
+        abort(400)
+
+    found = User.get_users(ids)
+    result = []
+    for user_id in dict.fromkeys(ids):  # keep the requested order, skip duplicates
+        u = found.get(user_id)
+        if not u:
+            continue
+        status = current_user.buddy_status(u)
+        if status == -1 or status >= 2:
+            profile = u.public_profile()
+        else:
+            profile = {"id": u.id, "username": u.username}
+        profile["buddy_status"] = status
+        result.append(profile)
+
+    return jsonify({"users": result})
+
+
+@bp.get("/buddies/pending/")
+@login_required
+def get_pending_buddies():
+    """Users who have sent the current user a buddy request"""
+    return jsonify({"users": User.get_usernames(buddy_graph.pending(current_user.id))})
+
+
+@bp.get("/buddies/mutual/<int:userid>/")
+@login_required
+def get_mutual_buddies(userid):
+    """Users who are buddies with both the current user and `userid`"""
+    # they're `userid`'s buddies, so only for those who may see their page (as in get_user())
+    if userid != current_user.id and buddy_graph.status(current_user.id, userid) < 2:
+        abort(HTTPStatus.FORBIDDEN)
+    return jsonify({"users": User.get_usernames(buddy_graph.mutual(current_user.id, userid))})
+
+
+@bp.get("/buddies/suggestions/")
+@login_required
+def get_buddy_suggestions():
+    """Buddies of the current user's buddies, ranked by how many buddies we share"""
+    limit = max(1, min(request.args.get("limit", 10, type=int), 100))
+    suggestions = buddy_graph.suggestions(current_user.id, limit)
+    shared = dict(suggestions)
+    users = User.get_usernames([user_id for (user_id, _) in suggestions])
+    for u in users:
+        u["mutual"] = shared[u["id"]]
+    return jsonify({"users": users})
+
+
+@bp.get("/events/")
+@login_required
+def get_events():
+    """A stream of Server-Sent Events about changes to the current user's buddies.
+
+    Each `buddy` event has `{"user": id, "status": buddy_status}` for a user whose
+    relation to us has changed (status as in User.buddy_status()). Changes made in
+    this process are sent right away; changes made by other worker processes are
+    found by checking the database every EVENTS_POLL_INTERVAL seconds.
+    """
+    app = current_app._get_current_object()
+    user_id = current_user.id
+    subscription = events.subscribe(user_id)
+    if subscription is None:
+        return "Too many event streams, please try again later.", HTTPStatus.SERVICE_UNAVAILABLE, {"Retry-After": "30"}
+    known = buddy_graph.relations(user_id)
+
+    def generate():
+        nonlocal known
+        deadline = time.monotonic() + app.config["EVENTS_STREAM_TIME"]
+        # reconnect 5 s after we close the stream; the comment line gets the headers out
+        yield "retry: 5000\n: connected\n\n"
+        while time.monotonic() < deadline:
+            try:
+                subscription.get(timeout=app.config["EVENTS_POLL_INTERVAL"])
+            except queue.Empty:
+                # the request is over, so this needs a context (and a connection) of its own
+                with app.app_context():
+                    sync_buddy_graph()
+            current = buddy_graph.relations(user_id)
+            changed = [other for other in known.keys() | current.keys() if known.get(other, 0) != current.get(other, 0)]
+            for other in sorted(changed):
+                yield f"event: buddy\ndata: {json.dumps({'user': other, 'status': current.get(other, 0)})}\n\n"
+            if not changed:
+                yield ": ping\n\n"  # notices when the browser has gone away
+            known = current
+
+    response = app.response_class(generate(), mimetype="text/event-stream")
+    # also when the generator never got started
+    response.call_on_close(lambda: events.unsubscribe(user_id, subscription))
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # don't let a proxy hold back events
+    return response
+
+
+@bp.route('/add_buddy/<adding_user_id>/<added_user_id>/', methods=['POST'])
 @login_required
 def add_buddy(adding_user_id, added_user_id):
     success = False
@@ -393,7 +1228,6 @@ def add_buddy(adding_user_id, added_user_id):
     u2 = User.get_user(added_user_id)
     
     if not (u2.id in u1['buddies']) and (current_user.id == int(adding_user_id)):
-        flask.flash(f"You sent a buddy invite to {u2.username}!")
         u1.add_buddy(u2)
         success = True
     
@@ -403,7 +1237,7 @@ def add_buddy(adding_user_id, added_user_id):
         return jsonify({'message': 'Something went wrong when adding your buddy.'})
  
  
-@app.route('/remove_buddy/<removing_user_id>/<removed_user_id>/', methods=['POST'])
+@bp.route('/remove_buddy/<removing_user_id>/<removed_user_id>/', methods=['POST'])
 @login_required
 def remove_buddy(removing_user_id, removed_user_id):
     success = False
@@ -412,7 +1246,6 @@ def remove_buddy(removing_user_id, removed_user_id):
     u2 = User.get_user(removed_user_id)
     
     if (u2.id in u1['buddies']) and (current_user.id == int(removing_user_id)):
-        flask.flash(f"You've removed {u2.username} as a buddy.")
         u1.remove_buddy(u2)
         success = True
     
@@ -423,15 +1256,101 @@ def remove_buddy(removing_user_id, removed_user_id):
  
 
 
-@app.before_request
+@bp.before_app_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+    g.template_time = 0.0
+
+
+def template_started(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+
+def template_finished(sender, template, context, **extra):
+    elapsed = time.perf_counter() - g.pop("template_start", time.perf_counter())
+    metrics.observe("headbook_template_render_seconds", elapsed, template=template.name)
+    g.template_time = g.get("template_time", 0.0) + elapsed
+
+
+@bp.after_app_request
+def record_timing(response):
+    if "request_start" not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or "none"
+    metrics.observe("headbook_request_seconds", elapsed, endpoint=endpoint)
+    metrics.inc("headbook_requests_total", endpoint=endpoint, status=response.status_code)
+
+    if current_app.config["SERVER_TIMING"] and not is_asset_request():
+        response.headers["Server-Timing"] = (
+            f'sql;dur={g.sql_time * 1000:.2f};desc="{g.sql_count} queries", '
+            f'tpl;dur={g.template_time * 1000:.2f}, '
+            f'total;dur={elapsed * 1000:.2f}'
+        )
+    return response
+
+
+@bp.get("/metrics")
+def get_metrics():
+    """Timings and cache statistics for this process, for Prometheus"""
+    if request.remote_addr not in current_app.config["METRICS_ALLOWED_IPS"]:
+        abort(404)
+    return metrics.render(), {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def is_asset_request():
+    """Static files don't need a CSP nonce or header"""
+    return request.endpoint == "headbook.serve_static"
+
+@bp.before_app_request
 def before_request():
+    if is_asset_request():
+        return
     # can be used to allow particular inline scripts with Content-Security-Policy
     g.csp_nonce = secrets.token_urlsafe(32)
 
+@bp.before_app_request
+def limit_requests():
+    """Turn away logins and buddy changes from clients that send too many, or when too
+    many are running already – before we look anyone up or check a password"""
+    route_class = RATE_LIMITED.get(request.endpoint)
+    if route_class is None or request.method != "POST":
+        return
+    try:
+        wait = limiter.check(route_class, {"ip": request.remote_addr, "user": claimed_user()})
+    except apsw.Error as e:
+        # better to let requests through than to fail them all
+        log.error("http", "rate limit store failed: %s", e)
+        wait = 0
+    if wait:
+        metrics.inc("headbook_rejected_total", route_class=route_class, reason="rate")
+        return "Too many requests, please slow down.", HTTPStatus.TOO_MANY_REQUESTS, {"Retry-After": str(math.ceil(wait))}
+    if not limiter.enter(route_class):
+        metrics.inc("headbook_rejected_total", route_class=route_class, reason="busy")
+        return "Server busy, please try again.", HTTPStatus.TOO_MANY_REQUESTS, {"Retry-After": "1"}
+    g.in_flight = route_class
+
+@bp.teardown_app_request
+def leave_in_flight(exc):
+    route_class = g.pop("in_flight", None)
+    if route_class:
+        limiter.leave(route_class)
+
+# after limit_requests(), so requests we turn away don't touch the database
+@bp.before_app_request
+def catch_up_buddy_graph():
+    """Each worker process has its own buddy graph; pick up changes made by the others"""
+    if not is_asset_request():
+        sync_buddy_graph()
+
 # Can be used to set HTTP headers on the responses
-@app.after_request
+@bp.after_app_request
 def after_request(response):
-    
+    if is_asset_request():
+        return response
+
     #Define the header
     csp_header = f"default-src 'self'; script-src 'self' 'nonce-{g.csp_nonce}'; style-src 'self' 'unsafe-inline'; img-src 'self' 'https://git.app.uib.no/*'; font-src 'self'"
     
@@ -455,12 +1374,12 @@ def safe_redirect_next():
     return redirect(next or '/')
 
 # For full RFC2324 compatibilty
-@app.get("/coffee/")
+@bp.get("/coffee/")
 def nocoffee():
     abort(418)
 
 
-@app.route("/coffee/", methods=["POST", "PUT"])
+@bp.route("/coffee/", methods=["POST", "PUT"])
 def gotcoffee():
     return "Thanks!"
 
@@ -483,92 +1402,209 @@ def color_constraint_check(color):
 ################################
 # For database access
 
+def get_db():
+    """Check out a pooled connection for the rest of this app context"""
+    if "db" not in g:
+        g.db = db.checkout()
+
+    return g.db
+
+
 def get_cursor():
     if "cursor" not in g:
-        g.cursor = db.cursor()
+        g.cursor = get_db().cursor()
 
     return g.cursor
 
 
-@app.teardown_appcontext
 def teardown_db(exception):
     cursor = g.pop("cursor", None)
 
     if cursor is not None:
         cursor.close()
 
+    conn = g.pop("db", None)
+    if conn is not None:
+        db.checkin(conn)
+
+    copy = g.pop("replica", None)
+    if copy is not None:
+        replica.checkin(copy)
+
+
+SECRET_PARAMS = {"password", "token_hash"}
 
 def sql_execute(stmt, *args, **kwargs):
-    debug(stmt, args or "", kwargs or "")
-    return get_cursor().execute(stmt, *args, **kwargs)
-
-
-def sql_init():
-    global db
-    db = apsw.Connection("./users.db")
-    if db.pragma("user_version") == 0:
-        sql_execute(
-            """CREATE TABLE IF NOT EXISTS users (
-            id integer PRIMARY KEY, 
-            username TEXT NOT NULL UNIQUE,
-            password TEXT NOT NULL,
-            info JSON NOT NULL);"""
-        )
-        sql_execute(
-            """CREATE TABLE IF NOT EXISTS tokens (
-            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-            token TEXT NOT NULL UNIQUE,
-            name TEXT
-            );"""
-        )
-        sql_execute(
-            """CREATE TABLE IF NOT EXISTS buddies (
-            user1_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-            user2_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-            PRIMARY KEY (user1_id, user2_id)
-            );"""
-        )
-        alice = User(
-            {
-                "username": "alice",
-                "password": "password123",
-                "color": "green",
-                "picture_url": "https://git.app.uib.no/uploads/-/system/user/avatar/788/avatar.png",
-                "buddies" : [bob.id]
-            }
-        )
-        alice.save()
-        alice.add_token("example")
-        
-        bob = User({"username": "bob", "password": "bananas", "color": "red"})
-        bob.save()
-        bob.add_token("test")
-        
-        bob.add_buddy(alice)
-        alice.add_buddy(bob)
-        
-        charlie = User({"username": "charlie", "password": "whatIs34+35", "color": "yellow"})
-        charlie.save()
-        charlie.add_token("figs")
-        
-        dennis = User({"username": "dennis", "password": "Strongpassw0rd?", "color": "black"})
-        dennis.save()
-        dennis.add_token("quark")
-        
-        dennis.add_buddy("alice")
-        dennis.add_buddy("charlie")
-        
-        sql_execute(
-            f"INSERT INTO buddies (user1_id, user2_id) VALUES ({alice.id}, {bob.id}), ({bob.id}, {alice.id});"
+    if log.enabled(DEBUG, "sql"):
+        params = args[0] if args else kwargs
+        if isinstance(params, dict):
+            params = {k: ("***" if k in SECRET_PARAMS else v) for (k, v) in params.items()}
+        log.emit(DEBUG, "sql", "%s %s", sql_label(stmt), params or "")
+    start = time.perf_counter()
+    try:
+        return get_cursor().execute(stmt, *args, **kwargs)
+    finally:
+        record_sql(stmt, time.perf_counter() - start)
+
+
+def sql_read(stmt, params=None):
+    """Execute a query on the users or buddies table, on the in-memory replica (REPLICA) if
+    it has caught up with this request's change counters, otherwise on the database"""
+    cursor = None
+    if replica:
+        # the request keeps its copy until teardown_db(), as cursors on it may still be open
+        if "replica" not in g:
+            g.replica = replica.checkout()
+        if g.replica is not None:
+            cursor = replica.cursor(g.replica, current_changes())
+    if cursor is None:
+        if replica:
+            metrics.inc("headbook_replica_reads_total", source="database")
+        return sql_execute(stmt, params)
+    metrics.inc("headbook_replica_reads_total", source="replica")
+    start = time.perf_counter()
+    try:
+        return cursor.execute(stmt, params)
+    finally:
+        record_sql(stmt, time.perf_counter() - start)
+
+
+def replica_refreshed(seconds, error):
+    """Called by the replica after copying the database"""
+    if error:
+        log.error("db", "copying the database into memory failed: %s", error)
+    else:
+        metrics.observe("headbook_replica_refresh_seconds", seconds)
+
+
+@functools.lru_cache(maxsize=1024)
+def sql_label(stmt):
+    return " ".join(stmt.split())
+
+
+def record_sql(stmt, elapsed):
+    metrics.observe("headbook_sql_seconds", elapsed, stmt=sql_label(stmt))
+    if flask.has_request_context():
+        g.sql_count = g.get("sql_count", 0) + 1
+        g.sql_time = g.get("sql_time", 0.0) + elapsed
+
+
+def check_schema(conn):
+    """Refuse to work with a database that `flask init-db` hasn't brought up to date"""
+    version = conn.pragma("user_version")
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(
+            f"database schema is at version {version}, not {SCHEMA_VERSION}; run `flask -A headbook init-db`"
         )
-        sql_execute("PRAGMA user_version = 1;")
-        task2c__DB_update()
 
-def task2c__DB_update():
-    sql = "UPDATE users SET password=:password WHERE username = :username;"
-    sql_execute(sql, {"username": "alice", "password": generate_password_hash("password123")})
-    sql_execute(sql, {"username": "bob", "password": generate_password_hash("bananas")})
+
+def sync_buddy_graph():
+    """Catch up with buddy changes made by other worker processes.
+
+    The changes since the graph's version are read from the buddy_changes log. The
+    graph is only read in full if it hasn't been loaded yet, or, in the background,
+    if the log no longer goes back far enough.
+    """
+    counter = current_changes()["buddies"]
+    # counters only go up; the graph can be ahead of a reading that is a moment old
+    if buddy_graph.version is not None and counter <= buddy_graph.version:
+        return
+    with buddy_graph_sync:
+        version = buddy_graph.version  # another thread may have caught up meanwhile
+        if version is None:
+            load_buddy_graph(get_db())
+        elif counter > version:
+            rows = sql_read(
+                "SELECT counter, user1_id, user2_id, added FROM buddy_changes WHERE counter > :version ORDER BY counter;",
+                {"version": version},
+            ).fetchall()
+            if rows and rows[0][0] == version + 1:
+                buddy_graph.apply([row[1:] for row in rows], rows[-1][0])
+                apply_pending_buddies()
+            else:
+                # some of the changes have been pruned from the log; serve the graph we have until it's reloaded
+                reload_buddy_graph_soon()
+
+
+def load_buddy_graph(conn):
+    """Read the whole buddies table into the buddy graph"""
+    start = time.perf_counter()
+    with conn:  # the counter and the rows from the same snapshot
+        counter = conn.execute("SELECT counter FROM changes WHERE name = 'buddies';").fetchone()[0]
+        edges = conn.execute("SELECT user1_id, user2_id FROM buddies;").fetchall()
+    buddy_graph.load(edges, counter)
+    apply_pending_buddies()
+    log.info("db", "loaded the buddy graph: %d edges in %.3fs", len(edges), time.perf_counter() - start)
+
+
+def apply_pending_buddies():
+    """Put our own buddy changes that haven't been committed yet (WRITE_BEHIND) back on the graph"""
+    if writes:
+        for ((_, a, b), added) in writes.pending_items("buddy"):
+            if added:
+                buddy_graph.add(a, b)
+            else:
+                buddy_graph.remove(a, b)
+
+
+def reload_buddy_graph_soon():
+    """Start reading the whole buddies table in the background, unless we're already at it"""
+    if buddy_graph_reload.acquire(blocking=False):
+        threading.Thread(target=reload_buddy_graph, name="buddy-graph-reload", daemon=True).start()
 
 
-with app.app_context():
-    sql_init()
+def reload_buddy_graph():
+    try:
+        conn = db.checkout()
+        try:
+            load_buddy_graph(conn)
+        finally:
+            db.checkin(conn)
+    except Exception as e:
+        log.error("db", "reloading the buddy graph failed: %s", e)
+    finally:
+        buddy_graph_reload.release()
+
+
+def warm_up():
+    """Get a new worker process ready for requests: load the buddy graph, and copy the
+    database into memory if REPLICA is on"""
+    conn = db.checkout()
+    try:
+        load_buddy_graph(conn)
+    finally:
+        db.checkin(conn)
+    if replica:
+        replica.refresh()
+
+
+@bp.cli.command("init-db")
+def init_db():
+    """Create the database, or upgrade it to the current schema.
+
+    A new database gets some example users. Run this before starting the server
+    (and after upgrading it); the server itself never changes the schema.
+    """
+    conn = apsw.Connection(current_app.config["DATABASE"])
+    conn.setbusytimeout(current_app.config["DB_BUSY_TIMEOUT"])
+    conn.pragma("journal_mode", "wal")
+    version = migrate(conn)
+    conn.close()
+    print(f"Database schema is at version {version}.")
+
+
+@bp.cli.command("check-queries")
+def check_queries():
+    """Fail if any SQL statement in the app would scan a whole table"""
+    conn = apsw.Connection(":memory:")
+    migrate(conn)
+    problems = check_query_plans(conn)
+    for (location, stmt, detail) in problems:
+        print(f"{location}: {detail}\n    {stmt}", file=sys.stderr)
+    if problems:
+        sys.exit(1)
+    print("All query plans ok.")
+
+
+bp.cli.add_command(import_data)
+bp.cli.add_command(export_data)
@@ -0,0 +1,82 @@
+import gzip, hashlib, os, re
+
+# compressing these doesn't help (PNG is already compressed)
+COMPRESSIBLE = {"js", "css", "html", "ico", "svg", "json"}
+# these may refer to other assets by URL, which we rewrite to the fingerprinted URL
+REWRITE = {"js", "css", "html"}
+
+
+class Asset:
+    def __init__(self, name, body, mimetype):
+        self.name = name
+        self.mimetype = mimetype
+        self.set_body(body)
+
+    def set_body(self, body):
+        self.body = body
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.gzip = None
+        if self.name.rsplit(".", 1)[-1] in COMPRESSIBLE:
+            compressed = gzip.compress(body, 9, mtime=0)
+            if len(compressed) < len(body):
+                self.gzip = compressed
+
+    @property
+    def url(self):
+        (stem, ext) = self.name.rsplit(".", 1)
+        return f"/{stem}.{self.digest}.{ext}"
+
+
+class AssetStore:
+    """The files in static/, loaded into memory at startup.
+
+    Each file gets a fingerprinted URL (`/script.<hash>.js`) that can be cached
+    forever, since new content means a new URL. References between assets
+    (e.g., `import ... from '/uhtml.js'`) are rewritten to fingerprinted URLs too.
+    """
+
+    def __init__(self, folder, mimetypes):
+        self.folder = folder
+        self.mimetypes = mimetypes  # extension -> mimetype; other files are ignored
+        self.assets = {}
+
+    def load(self):
+        assets = {}
+        for name in sorted(os.listdir(self.folder)):
+            ext = name.rsplit(".", 1)[-1]
+            path = os.path.join(self.folder, name)
+            if "." in name and ext in self.mimetypes and os.path.isfile(path):
+                with open(path, "rb") as f:
+                    assets[name] = Asset(name, f.read(), self.mimetypes[ext])
+
+        # point references at the other assets' fingerprinted URLs (one level
+        # deep: fine as long as an asset that refers to others isn't referred to
+        # by yet another asset that is processed before it)
+        pattern = re.compile(r"""(['"(])/(%s)(['")])""" % "|".join(re.escape(n) for n in assets))
+        for asset in assets.values():
+            if asset.name.rsplit(".", 1)[-1] in REWRITE and assets:
+                body = pattern.sub(lambda m: m[1] + assets[m[2]].url + m[3], asset.body.decode())
+                asset.set_body(body.encode())
+
+        self.assets = assets
+
+    def url(self, name):
+        """Fingerprinted URL of an asset (for templates)"""
+        asset = self.assets.get(name)
+        return asset.url if asset else f"/{name}"
+
+    def lookup(self, filename, ext):
+        """Find the asset for a request path `/<filename>.<ext>`.
+
+        Returns (asset, fingerprinted), or (None, False) if there is no such asset.
+        """
+        asset = self.assets.get(f"{filename}.{ext}")
+        if asset:
+            return (asset, False)
+        if "." in filename:
+            (stem, digest) = filename.rsplit(".", 1)
+            asset = self.assets.get(f"{stem}.{ext}")
+            if asset:
+                # an old fingerprint still gets the current file, just not cached for long
+                return (asset, digest == asset.digest)
+        return (None, False)
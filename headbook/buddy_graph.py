@@ -0,0 +1,117 @@
+import heapq, itertools, threading
+from collections import Counter
+
+
+class BuddyGraph:
+    """In-memory copy of the buddies table, indexed in both directions.
+
+    `_out[u]` is the set of users `u` has added, `_in[u]` the set of users who have
+    added `u`. Two users are buddies when each has added the other; an edge in only
+    one direction is a pending buddy request.
+
+    `version` is the value of the buddies change counter (see migrations.add_versions)
+    that the graph is known to be up to date with, or None if it hasn't been loaded.
+    """
+
+    # don't look at more than this many buddies per user when making suggestions,
+    # so a few very popular users can't make the query slow
+    SUGGESTION_FANOUT = 500
+
+    def __init__(self):
+        self._out = {}
+        self._in = {}
+        self._lock = threading.Lock()
+        self.version = None
+
+    def load(self, edges, version=None):
+        """Replace the whole graph with the given (user1_id, user2_id) edges"""
+        out, in_ = {}, {}
+        for (a, b) in edges:
+            out.setdefault(a, set()).add(b)
+            in_.setdefault(b, set()).add(a)
+        with self._lock:
+            self._out, self._in = out, in_
+            self.version = version
+
+    def advance(self, version, since=None):
+        """After add()/remove(): if the counter has moved from `since` (by default,
+        version - 1) to `version` by our own changes only, and the graph was up to date
+        with `since`, then it is up to date with `version`"""
+        if since is None:
+            since = version - 1
+        with self._lock:
+            if self.version is not None and self.version == since:
+                self.version = version
+
+    def apply(self, changes, version):
+        """Apply (user1_id, user2_id, added) changes, oldest first; the graph is then up to
+        date with `version`"""
+        with self._lock:
+            for (a, b, added) in changes:
+                if added:
+                    self._out.setdefault(a, set()).add(b)
+                    self._in.setdefault(b, set()).add(a)
+                else:
+                    self._out.get(a, set()).discard(b)
+                    self._in.get(b, set()).discard(a)
+            self.version = version
+
+    def add(self, a, b):
+        with self._lock:
+            self._out.setdefault(a, set()).add(b)
+            self._in.setdefault(b, set()).add(a)
+
+    def remove(self, a, b):
+        with self._lock:
+            self._out.get(a, set()).discard(b)
+            self._in.get(b, set()).discard(a)
+
+    def buddies(self, a):
+        """The users `a` has added (confirmed or not), in id order"""
+        with self._lock:
+            return sorted(self._out.get(a, ()))
+
+    def status(self, a, b):
+        """Relation between a and b, as in User.buddy_status()"""
+        if a == b:
+            return -1
+        with self._lock:
+            a_added = b in self._out.get(a, ())
+            b_added = a in self._out.get(b, ())
+        return (1 if a_added else 0) + (2 if b_added else 0)
+
+    def relations(self, a):
+        """{user id: status} for everyone `a` has a relation with (status as in status())"""
+        with self._lock:
+            out, in_ = self._out.get(a, set()), self._in.get(a, set())
+            return {b: (1 if b in out else 0) + (2 if b in in_ else 0) for b in out | in_}
+
+    def _confirmed(self, a):
+        return self._out.get(a, set()) & self._in.get(a, set())
+
+    def confirmed(self, a):
+        """Users who are buddies with `a` in both directions"""
+        with self._lock:
+            return sorted(self._confirmed(a))
+
+    def mutual(self, a, b):
+        """Users who are (confirmed) buddies with both a and b"""
+        with self._lock:
+            return sorted(self._confirmed(a) & self._confirmed(b))
+
+    def pending(self, a):
+        """Users who have added `a`, but whom `a` hasn't added back"""
+        with self._lock:
+            return sorted(self._in.get(a, set()) - self._out.get(a, set()))
+
+    def suggestions(self, a, limit=10):
+        """Buddies of a's buddies that a hasn't added yet, as (user_id, mutual_count),
+        most shared buddies first"""
+        with self._lock:
+            known = self._out.get(a, set())
+            counts = Counter()
+            for friend in itertools.islice(self._confirmed(a), self.SUGGESTION_FANOUT):
+                for other in itertools.islice(self._confirmed(friend), self.SUGGESTION_FANOUT):
+                    if other != a and other not in known:
+                        counts[other] += 1
+        return heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
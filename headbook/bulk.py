@@ -0,0 +1,220 @@
+"""Bulk import/export of users, tokens and buddies, as `flask` commands.
+
+Records are read and written one line at a time (JSON Lines or CSV), and
+imported with executemany() in large transactions, so loading millions of rows
+costs a handful of commits instead of one per row.
+
+    flask -A headbook import-data users users.jsonl
+    flask -A headbook export-data buddies buddies.csv
+"""
+import contextlib, csv, json, time
+import apsw, click
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from .migrations import migrate, PROFILE_COLUMNS
+from .passwords import hash_token
+
+# columns of each table, in the order used for CSV files
+TABLES = {
+    "users": ["id", "username", "password", *PROFILE_COLUMNS, "info"],
+    "tokens": ["user_id", "token_hash", "name"],
+    "buddies": ["user1_id", "user2_id"],
+}
+
+CONFLICT = {"abort": "INSERT", "ignore": "INSERT OR IGNORE", "replace": "INSERT OR REPLACE"}
+
+
+def connect(path):
+    """Open a connection for bulk work, with the schema brought up to date"""
+    conn = apsw.Connection(path)
+    conn.setbusytimeout(current_app.config["DB_BUSY_TIMEOUT"])
+    conn.pragma("journal_mode", "wal")
+    conn.pragma("synchronous", "normal")
+    conn.pragma("cache_size", -65536)  # 64 MiB page cache while loading
+    migrate(conn)
+    return conn
+
+
+def guess_format(path, fmt):
+    if fmt:
+        return fmt
+    return "csv" if path.endswith(".csv") else "jsonl"
+
+
+def open_path(path, mode="r"):
+    """Open a file for csv/json lines, or stdin/stdout for '-'"""
+    if path == "-":
+        return contextlib.nullcontext(click.get_text_stream("stdin" if mode == "r" else "stdout"))
+    return open(path, mode, newline="")
+
+
+def read_records(f, fmt):
+    """Yield one dict per input line"""
+    if fmt == "csv":
+        yield from csv.DictReader(f)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def user_row(record, hash_passwords):
+    """Turn an exported user record into an (id, username, password, <PROFILE_COLUMNS>, info) row.
+
+    Any field that isn't a column goes into `info`; from CSV, an `info` column
+    holds the JSON text itself. Profile fields found in `info` are moved to their columns.
+    """
+    record = dict(record)
+    info = record.pop("info", None)
+    info = json.loads(info) if isinstance(info, str) and info else dict(info or {})
+    user_id = record.pop("id", None)
+    username = record.pop("username")
+    password = record.pop("password")
+    if hash_passwords:
+        password = generate_password_hash(password)
+    info.update({k: v for k, v in record.items() if v not in (None, "")})
+    info.pop("buddies", None)
+    profile = tuple(info.pop(column, None) for column in PROFILE_COLUMNS)
+    return (int(user_id) if user_id not in (None, "") else None, username, password, *profile, json.dumps(info))
+
+
+def token_row(record):
+    """Turn a token record into a (user_id, token_hash, name) row.
+
+    Takes either the token itself (`token`) or its hex digest, as exported (`token_hash`).
+    """
+    if record.get("token"):
+        token_hash = hash_token(record["token"])
+    else:
+        token_hash = bytes.fromhex(record["token_hash"])
+    return (record["user_id"], token_hash, record.get("name"))
+
+
+def record_row(table, record, hash_passwords=False):
+    if table == "users":
+        return user_row(record, hash_passwords)
+    if table == "tokens":
+        return token_row(record)
+    return tuple(record.get(column) for column in TABLES[table])
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Progress:
+    """Print a progress line to stderr every few seconds"""
+
+    def __init__(self, label, every=2.0):
+        self.label = label
+        self.every = every
+        self.count = 0
+        self.start = self.last = time.monotonic()
+
+    def update(self, n):
+        self.count += n
+        now = time.monotonic()
+        if now - self.last >= self.every:
+            self.last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        click.echo(f"{self.label}: {self.count} rows ({self.count / elapsed:.0f} rows/s)", err=True)
+
+
+def insert_sql(table, on_conflict):
+    columns = TABLES[table]
+    sql = f"INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    if table == "users" and on_conflict == "replace":
+        # update existing users in place: INSERT OR REPLACE would delete the row and insert
+        # a new one, with its version back at 1, so ETags handed out before would match
+        # again. An update bumps the version (users_updated trigger) like any other.
+        updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column != "id")
+        return f"INSERT {sql} ON CONFLICT(id) DO UPDATE SET {updates} ON CONFLICT(username) DO UPDATE SET {updates};"
+    return f"{CONFLICT[on_conflict]} {sql};"
+
+
+def import_rows(conn, table, rows, batch_size=50000, on_conflict="abort", progress=None):
+    """Insert rows into `table`, committing once per batch; returns the number of rows"""
+    sql = insert_sql(table, on_conflict)
+    count = 0
+    for batch in batches(rows, batch_size):
+        with conn:
+            conn.executemany(sql, batch)
+        count += len(batch)
+        if progress:
+            progress.update(len(batch))
+    return count
+
+
+def export_rows(conn, table):
+    """Yield all records of `table` as dicts, in primary key order"""
+    columns = TABLES[table]
+    order = {"users": "id", "tokens": "user_id", "buddies": "user1_id, user2_id"}[table]
+    for row in conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {order};"):
+        record = dict(zip(columns, row))
+        if table == "users":
+            for column in PROFILE_COLUMNS:
+                if record[column] is None:
+                    del record[column]
+            record.update(json.loads(record.pop("info")))
+        elif table == "tokens":
+            record["token_hash"] = record["token_hash"].hex()
+        yield record
+
+
+@click.command("import-data")
+@click.argument("table", type=click.Choice(list(TABLES)))
+@click.argument("path", type=click.Path(allow_dash=True))
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]), help="Input format (default: from file name)")
+@click.option("--batch-size", default=50000, show_default=True, help="Rows per transaction")
+@click.option("--on-conflict", type=click.Choice(list(CONFLICT)), default="abort", show_default=True)
+@click.option("--hash-passwords", is_flag=True, help="Input has plaintext passwords (slow!)")
+def import_data(table, path, fmt, batch_size, on_conflict, hash_passwords):
+    """Load users, tokens or buddies from a JSON Lines or CSV file ('-' for stdin).
+
+    Running servers keep their caches and buddy graph; restart them afterwards.
+    """
+    fmt = guess_format(path, fmt)
+    conn = connect(current_app.config["DATABASE"])
+    progress = Progress(f"import {table}")
+    with open_path(path) as f:
+        rows = (record_row(table, record, hash_passwords) for record in read_records(f, fmt))
+        import_rows(conn, table, rows, batch_size, on_conflict, progress)
+    progress.report()
+    conn.execute("ANALYZE;")
+    conn.close()
+
+
+@click.command("export-data")
+@click.argument("table", type=click.Choice(list(TABLES)))
+@click.argument("path", type=click.Path(allow_dash=True), default="-")
+@click.option("--format", "fmt", type=click.Choice(["jsonl", "csv"]), help="Output format (default: from file name)")
+def export_data(table, path, fmt):
+    """Write users, tokens or buddies to a JSON Lines or CSV file (default: stdout)"""
+    fmt = guess_format(path, fmt)
+    conn = connect(current_app.config["DATABASE"])
+    progress = Progress(f"export {table}")
+    with open_path(path, "w") as f:
+        if fmt == "csv":
+            writer = csv.DictWriter(f, TABLES[table])
+            writer.writeheader()
+        for record in export_rows(conn, table):
+            if fmt == "csv":
+                if table == "users":
+                    columns = {k: record.pop(k, None) for k in TABLES["users"] if k != "info"}
+                    record = {**columns, "info": json.dumps(record)}
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record) + "\n")
+            progress.update(1)
+    progress.report()
+    conn.close()
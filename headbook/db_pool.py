@@ -0,0 +1,89 @@
+import os, queue, threading
+import apsw
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free in time"""
+
+
+class ConnectionPool:
+    """A bounded pool of apsw connections to a single SQLite database.
+
+    Connections are opened lazily (up to `size` of them), put in WAL mode so
+    readers don't block the writer, and given a busy timeout so concurrent
+    writers wait for the lock instead of failing straight away.
+
+    The pool is fork-aware: a forked child (e.g., a web server worker) never uses
+    connections inherited from its parent, but opens its own.
+    """
+
+    def __init__(self, path, size=8, busy_timeout=5000, checkout_timeout=30.0, setup=None):
+        self.path = path
+        self.size = size
+        self.busy_timeout = busy_timeout
+        self.checkout_timeout = checkout_timeout
+        self.setup = setup  # called with each new connection
+        self._reset()
+
+    def _reset(self):
+        # anything inherited across fork() belongs to the parent; SQLite connections
+        # must not be used by two processes, so we just forget them
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._pid = os.getpid()
+
+    def connect(self):
+        """Open a connection set up like the pooled ones, but not kept by the pool"""
+        conn = apsw.Connection(self.path)
+        conn.setbusytimeout(self.busy_timeout)
+        conn.pragma("journal_mode", "wal")
+        # WAL + NORMAL is durable against application crashes; only an OS
+        # crash/power loss can roll back the last few commits
+        conn.pragma("synchronous", "normal")
+        if self.setup:
+            self.setup(conn)
+        return conn
+
+    def checkout(self):
+        """Get a connection, opening a new one if the pool isn't full yet"""
+        if self._pid != os.getpid():
+            self._reset()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return self.connect()
+                except BaseException:
+                    self._opened -= 1
+                    raise
+
+        try:
+            return self._idle.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"no database connection available after {self.checkout_timeout}s") from None
+
+    def checkin(self, conn):
+        """Return a connection to the pool"""
+        if self._pid != os.getpid():
+            return  # checked out before a fork; not ours
+        if conn.in_transaction:
+            # don't hand a half-finished transaction to the next request
+            conn.execute("ROLLBACK;")
+        self._idle.put(conn)
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
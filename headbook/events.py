@@ -0,0 +1,49 @@
+"""In-process publish/subscribe, for pushing changes to browsers (see /events/).
+
+Each subscriber gets its own queue. publish() never waits: if a subscriber's
+queue is full, the event is dropped for that subscriber. Events only tell a
+stream that something has changed; the stream works out what to send from the
+current state, so dropped events (and changes made by other processes, which
+never reach our queues) are picked up the next time it looks.
+"""
+import queue, threading
+
+
+class EventBus:
+    def __init__(self, max_subscribers=64, queue_size=100):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self._subscribers = {}  # key -> set of queues
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, key):
+        """A new queue for events published to `key`, or None if there are too many subscribers"""
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+            q = queue.Queue(self.queue_size)
+            self._subscribers.setdefault(key, set()).add(q)
+            self._count += 1
+            return q
+
+    def unsubscribe(self, key, q):
+        with self._lock:
+            queues = self._subscribers.get(key, set())
+            if q in queues:
+                queues.discard(q)
+                self._count -= 1
+                if not queues:
+                    del self._subscribers[key]
+
+    def publish(self, key, event):
+        with self._lock:
+            queues = list(self._subscribers.get(key, ()))
+        for q in queues:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def __len__(self):
+        return self._count
@@ -0,0 +1,114 @@
+"""Leveled, structured (JSON Lines) logging with a background writer thread.
+
+Calls below the active level return right away, before anything is
+formatted, and so do calls dropped by per-category sampling. Records that do
+get through are only put on a queue; formatting and writing happens in the
+writer thread. If the queue is full, records are dropped (and counted) rather
+than slowing down requests.
+
+    log.debug("sql", "%s %s", stmt, params)   # "%" formatting happens later, if at all
+    if log.enabled(DEBUG, "forms"):            # guard anything that is costly to compute...
+        log.emit(DEBUG, "forms", "received %s", expensive())  # ...and don't sample it twice
+"""
+import atexit, json, os, queue, random, sys, threading, time
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+LEVELS = {name: level for (level, name) in LEVEL_NAMES.items()}
+
+
+class Logger:
+    def __init__(self, level=INFO, stream=None, queue_size=10000, sampling=None, context=None):
+        """`sampling` maps category -> fraction of records to keep; `context` is an optional
+        function returning extra fields (e.g., the current user) for each record"""
+        self.level = LEVELS[level.lower()] if isinstance(level, str) else level
+        self.stream = stream or sys.stderr
+        self.sampling = dict(sampling or {})
+        self.context = context
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def enabled(self, level, category):
+        """Whether to log a record; this is where it is sampled, so call it once per record"""
+        if level < self.level:
+            return False
+        rate = self.sampling.get(category, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+    def log(self, level, category, msg, *args, **fields):
+        if self.enabled(level, category):
+            self.emit(level, category, msg, *args, **fields)
+
+    def emit(self, level, category, msg, *args, **fields):
+        """Log a record that enabled() has already let through"""
+        if self.context:
+            fields = {**self.context(), **fields}
+        self._start()
+        try:
+            self._queue.put_nowait((time.time(), level, category, msg, args, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, category, msg, *args, **fields):
+        if DEBUG >= self.level:
+            self.log(DEBUG, category, msg, *args, **fields)
+
+    def info(self, category, msg, *args, **fields):
+        if INFO >= self.level:
+            self.log(INFO, category, msg, *args, **fields)
+
+    def warning(self, category, msg, *args, **fields):
+        if WARNING >= self.level:
+            self.log(WARNING, category, msg, *args, **fields)
+
+    def error(self, category, msg, *args, **fields):
+        if ERROR >= self.level:
+            self.log(ERROR, category, msg, *args, **fields)
+
+    def _start(self):
+        # (re)start the writer thread, also in a freshly forked worker, which
+        # inherits our state but not our threads
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self._queue.maxsize)
+                self._thread = threading.Thread(target=self._write_loop, name="log-writer", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _format(self, record):
+        (ts, level, category, msg, args, fields) = record
+        try:
+            text = msg % args if args else msg
+        except Exception as e:
+            text = f"{msg!r} {args!r} (format error: {e})"
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts)) + f".{int(ts % 1 * 1000):03d}Z",
+            "level": LEVEL_NAMES.get(level, str(level)),
+            "cat": category,
+            "msg": text,
+            **fields,
+        }
+        return json.dumps(entry, default=str)
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            try:
+                self.stream.write(self._format(record) + "\n")
+                if self._queue.empty():
+                    self.stream.flush()
+            except Exception:
+                pass  # nowhere to report it
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until everything logged so far has been written"""
+        if self._pid == os.getpid():
+            self._queue.join()
@@ -0,0 +1,90 @@
+"""Request, SQL and template timings, exported in Prometheus text format.
+
+Numbers are per process; with several workers, each one has its own.
+"""
+import bisect, threading
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+def label_str(labels):
+    def escape(v):
+        return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return ",".join(f'{k}="{escape(v)}"' for (k, v) in labels)
+
+
+class Metrics:
+    """Collects named histograms and counters, keyed by label values"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # name -> {labels: Histogram}
+        self._counters = {}    # name -> {labels: number}
+        self._help = {}
+        self._caches = {}      # name -> object with .stats()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = Histogram()
+            h.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def add_cache(self, name, cache):
+        """Report hits/misses/size of a cache (anything with a stats() method)"""
+        self._caches[name] = cache
+
+    def render(self):
+        """All metrics in Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for (name, series) in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for (labels, value) in sorted(series.items()):
+                    lines.append(f"{name}{{{label_str(labels)}}} {value}")
+            for (name, series) in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for (labels, h) in sorted(series.items()):
+                    cumulative = 0
+                    for (bound, count) in zip(list(h.buckets) + ["+Inf"], h.counts):
+                        cumulative += count
+                        le = label_str(labels + (("le", bound),))
+                        lines.append(f"{name}_bucket{{{le}}} {cumulative}")
+                    lines.append(f"{name}_sum{{{label_str(labels)}}} {h.sum}")
+                    lines.append(f"{name}_count{{{label_str(labels)}}} {h.count}")
+
+        for (stat, kind) in [("hits", "counter"), ("misses", "counter"), ("size", "gauge")]:
+            name = f"headbook_cache_{stat}" + ("_total" if kind == "counter" else "")
+            lines.append(f"# TYPE {name} {kind}")
+            for (cache_name, cache) in sorted(self._caches.items()):
+                lines.append(f'{name}{{cache="{cache_name}"}} {cache.stats()[stat]}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,350 @@
+"""Database schema migrations.
+
+Each migration brings the schema from version N-1 to N (as stored in
+`PRAGMA user_version`). They run in order, each in its own transaction, so a
+failed step leaves the database at the previous version.
+"""
+import ast, json, os, re, secrets
+from werkzeug.security import generate_password_hash
+from .passwords import hash_token
+
+# profile fields stored in columns of their own (since version 6); other fields go in `info`
+PROFILE_COLUMNS = ["color", "birthdate", "picture_url", "about"]
+
+
+def initial_schema(conn):
+    """Version 1: users, tokens and buddies, with some example users"""
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS users (
+        id integer PRIMARY KEY,
+        username TEXT NOT NULL UNIQUE,
+        password TEXT NOT NULL,
+        info JSON NOT NULL);"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS tokens (
+        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+        token TEXT NOT NULL UNIQUE,
+        name TEXT
+        );"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS buddies (
+        user1_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+        user2_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+        PRIMARY KEY (user1_id, user2_id)
+        );"""
+    )
+
+    example_users = [
+        ("alice", "password123", {"color": "green", "picture_url": "https://git.app.uib.no/uploads/-/system/user/avatar/788/avatar.png"}, "example"),
+        ("bob", "bananas", {"color": "red"}, "test"),
+        ("charlie", "whatIs34+35", {"color": "yellow"}, "figs"),
+        ("dennis", "Strongpassw0rd?", {"color": "black"}, "quark"),
+    ]
+    for (username, password, info, token_name) in example_users:
+        conn.execute(
+            "INSERT OR IGNORE INTO users (username, password, info) VALUES (?, ?, json(?));",
+            (username, generate_password_hash(password), json.dumps(info)),
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO tokens (user_id, token, name) SELECT id, ?, ? FROM users WHERE username = ?;",
+            (secrets.token_urlsafe(32), token_name, username),
+        )
+
+    for (user1, user2) in [("alice", "bob"), ("bob", "alice"), ("dennis", "alice"), ("dennis", "charlie")]:
+        conn.execute(
+            """INSERT OR IGNORE INTO buddies (user1_id, user2_id)
+            SELECT a.id, b.id FROM users a, users b WHERE a.username = ? AND b.username = ?;""",
+            (user1, user2),
+        )
+
+
+def add_indexes(conn):
+    """Version 2: indexes for looking up buddies in reverse and tokens by user"""
+    # the primary key only covers "who have I added"; this one covers "who added me"
+    conn.execute("CREATE INDEX IF NOT EXISTS buddies_user2 ON buddies (user2_id, user1_id);")
+    # covers get_tokens() without touching the table
+    conn.execute("CREATE INDEX IF NOT EXISTS tokens_user ON tokens (user_id, token, name);")
+    conn.execute("ANALYZE;")
+
+
+def hash_tokens(conn):
+    """Version 3: store SHA-256 digests of access tokens instead of the tokens themselves"""
+    conn.execute(
+        """CREATE TABLE tokens_new (
+        user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+        token_hash BLOB NOT NULL UNIQUE,
+        name TEXT
+        );"""
+    )
+    old = conn.execute("SELECT user_id, token, name FROM tokens;").fetchall()
+    conn.executemany(
+        "INSERT INTO tokens_new (user_id, token_hash, name) VALUES (?, ?, ?);",
+        [(user_id, hash_token(token), name) for (user_id, token, name) in old],
+    )
+    conn.execute("DROP TABLE tokens;")
+    conn.execute("ALTER TABLE tokens_new RENAME TO tokens;")
+    conn.execute("CREATE INDEX tokens_user ON tokens (user_id, token_hash, name);")
+
+
+def add_versions(conn):
+    """Version 4: row versions for users and change counters, kept up to date by triggers.
+
+    A user's version changes whenever their row or their buddy list changes; the
+    counters in `changes` count all changes to users and to buddies. Together they
+    let us tell whether a client's (or a cache's) copy is still current, without
+    loading the data.
+    """
+    conn.execute("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 1;")
+    conn.execute(
+        """CREATE TABLE changes (
+        name TEXT PRIMARY KEY,
+        counter INTEGER NOT NULL
+        ) WITHOUT ROWID;"""
+    )
+    conn.execute("INSERT INTO changes (name, counter) VALUES ('users', 0), ('buddies', 0);")
+    conn.execute(
+        """CREATE TRIGGER users_inserted AFTER INSERT ON users BEGIN
+        UPDATE changes SET counter = counter + 1 WHERE name = 'users';
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER users_updated AFTER UPDATE OF username, password, info ON users BEGIN
+        UPDATE users SET version = version + 1 WHERE id = new.id;
+        UPDATE changes SET counter = counter + 1 WHERE name = 'users';
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER users_deleted AFTER DELETE ON users BEGIN
+        UPDATE changes SET counter = counter + 1 WHERE name = 'users';
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER buddies_inserted AFTER INSERT ON buddies BEGIN
+        UPDATE users SET version = version + 1 WHERE id = new.user1_id;
+        UPDATE changes SET counter = counter + 1 WHERE name = 'buddies';
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER buddies_deleted AFTER DELETE ON buddies BEGIN
+        UPDATE users SET version = version + 1 WHERE id = old.user1_id;
+        UPDATE changes SET counter = counter + 1 WHERE name = 'buddies';
+        END;"""
+    )
+
+
+def add_search(conn):
+    """Version 5: full-text index over usernames and the 'about' text, kept in sync by triggers"""
+    conn.execute(
+        """CREATE VIRTUAL TABLE users_fts USING fts5(
+        username, about,
+        prefix = '2 3',
+        tokenize = 'unicode61 remove_diacritics 2'
+        );"""
+    )
+    conn.execute(
+        """INSERT INTO users_fts (rowid, username, about)
+        SELECT id, username, coalesce(json_extract(info, '$.about'), '') FROM users;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER users_fts_inserted AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, username, about)
+        VALUES (new.id, new.username, coalesce(json_extract(new.info, '$.about'), ''));
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER users_fts_updated AFTER UPDATE OF username, info ON users BEGIN
+        UPDATE users_fts SET username = new.username, about = coalesce(json_extract(new.info, '$.about'), '')
+        WHERE rowid = new.id;
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER users_fts_deleted AFTER DELETE ON users BEGIN
+        DELETE FROM users_fts WHERE rowid = old.id;
+        END;"""
+    )
+
+
+def split_profile(conn):
+    """Version 6: the profile form's fields get their own columns; `info` keeps anything else.
+
+    Saving a profile can then update just the fields that changed, and queries can
+    select (or index) a single field without parsing JSON.
+    """
+    for column in PROFILE_COLUMNS:
+        conn.execute(f"ALTER TABLE users ADD COLUMN {column} TEXT;")
+    conn.execute(
+        """UPDATE users SET
+        color = json_extract(info, '$.color'),
+        birthdate = json_extract(info, '$.birthdate'),
+        picture_url = json_extract(info, '$.picture_url'),
+        about = json_extract(info, '$.about'),
+        info = json_remove(info, '$.color', '$.birthdate', '$.picture_url', '$.about', '$.buddies');"""
+    )
+    # the triggers must also fire for (and read from) the new columns
+    for trigger in ["users_updated", "users_fts_inserted", "users_fts_updated"]:
+        conn.execute(f"DROP TRIGGER {trigger};")
+    conn.execute(
+        """CREATE TRIGGER users_updated
+        AFTER UPDATE OF username, password, info, color, birthdate, picture_url, about ON users BEGIN
+        UPDATE users SET version = version + 1 WHERE id = new.id;
+        UPDATE changes SET counter = counter + 1 WHERE name = 'users';
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER users_fts_inserted AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, username, about) VALUES (new.id, new.username, coalesce(new.about, ''));
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER users_fts_updated AFTER UPDATE OF username, about ON users BEGIN
+        UPDATE users_fts SET username = new.username, about = coalesce(new.about, '') WHERE rowid = new.id;
+        END;"""
+    )
+
+
+def log_buddy_changes(conn):
+    """Version 7: a log of the latest changes to buddies, numbered by the buddies change counter.
+
+    A worker whose buddy graph is a few changes behind can then apply just those,
+    instead of reading the whole buddies table again. Only the last 10000 changes
+    are kept.
+    """
+    conn.execute(
+        """CREATE TABLE buddy_changes (
+        counter INTEGER PRIMARY KEY,
+        user1_id INTEGER NOT NULL,
+        user2_id INTEGER NOT NULL,
+        added INTEGER NOT NULL
+        );"""
+    )
+    for trigger in ["buddies_inserted", "buddies_deleted"]:
+        conn.execute(f"DROP TRIGGER {trigger};")
+    conn.execute(
+        """CREATE TRIGGER buddies_inserted AFTER INSERT ON buddies BEGIN
+        UPDATE users SET version = version + 1 WHERE id = new.user1_id;
+        UPDATE changes SET counter = counter + 1 WHERE name = 'buddies';
+        INSERT INTO buddy_changes (counter, user1_id, user2_id, added)
+            SELECT counter, new.user1_id, new.user2_id, 1 FROM changes WHERE name = 'buddies';
+        DELETE FROM buddy_changes WHERE counter <= (SELECT counter FROM changes WHERE name = 'buddies') - 10000;
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER buddies_deleted AFTER DELETE ON buddies BEGIN
+        UPDATE users SET version = version + 1 WHERE id = old.user1_id;
+        UPDATE changes SET counter = counter + 1 WHERE name = 'buddies';
+        INSERT INTO buddy_changes (counter, user1_id, user2_id, added)
+            SELECT counter, old.user1_id, old.user2_id, 0 FROM changes WHERE name = 'buddies';
+        DELETE FROM buddy_changes WHERE counter <= (SELECT counter FROM changes WHERE name = 'buddies') - 10000;
+        END;"""
+    )
+
+
+def count_token_changes(conn):
+    """Version 8: a change counter for tokens, bumped when one is deleted (revoked) or changed.
+
+    Processes cache who owns a token; when the counter moves, they forget them,
+    so a revoked token stops working everywhere at once.
+    """
+    conn.execute("INSERT INTO changes (name, counter) VALUES ('tokens', 0);")
+    conn.execute(
+        """CREATE TRIGGER tokens_deleted AFTER DELETE ON tokens BEGIN
+        UPDATE changes SET counter = counter + 1 WHERE name = 'tokens';
+        END;"""
+    )
+    conn.execute(
+        """CREATE TRIGGER tokens_updated AFTER UPDATE ON tokens BEGIN
+        UPDATE changes SET counter = counter + 1 WHERE name = 'tokens';
+        END;"""
+    )
+
+
+# (version, step) – append new migrations at the end, never change old ones
+MIGRATIONS = [
+    (1, initial_schema),
+    (2, add_indexes),
+    (3, hash_tokens),
+    (4, add_versions),
+    (5, add_search),
+    (6, split_profile),
+    (7, log_buddy_changes),
+    (8, count_token_changes),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn, target=SCHEMA_VERSION):
+    """Run any migrations the database hasn't seen yet; returns the final version"""
+    for (version, step) in MIGRATIONS:
+        if version > target:
+            break
+        # IMMEDIATE takes the write lock up front, so if several processes start
+        # at once, only one of them runs each step and the others see the new version
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            if conn.pragma("user_version") < version:
+                step(conn)
+                conn.pragma("user_version", version)
+            conn.execute("COMMIT;")
+        except BaseException:
+            conn.execute("ROLLBACK;")
+            raise
+    return conn.pragma("user_version")
+
+
+################################
+# Query plan check
+
+# modules whose SQL statements are checked by check_query_plans()
+QUERY_MODULES = ["app.py"]
+
+# statements that are meant to read a whole table
+FULL_SCAN_OK = {
+    "SELECT user1_id, user2_id FROM buddies;",  # loads the buddy graph at startup
+}
+
+SQL_START = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b")
+SQL_PARAM = re.compile(r"[:@$](\w+)")
+
+
+def sql_statements(path):
+    """Find the string literals in a Python source file that look like SQL statements"""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    # pieces of f-strings aren't whole statements (and can't be checked without their values)
+    fragments = {id(part) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for part in node.values}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and SQL_START.match(node.value) and id(node) not in fragments:
+            yield (node.lineno, node.value)
+
+
+def check_query_plans(conn, modules=QUERY_MODULES):
+    """Run EXPLAIN QUERY PLAN on every SQL statement in `modules`.
+
+    Returns a list of (location, statement, plan detail) for statements that scan a
+    whole table (unless listed in FULL_SCAN_OK) or that fail to prepare.
+    """
+    base = os.path.dirname(os.path.abspath(__file__))
+    problems = []
+    for module in modules:
+        for (lineno, stmt) in sql_statements(os.path.join(base, module)):
+            location = f"{module}:{lineno}"
+            normalized = " ".join(stmt.split())
+            try:
+                # bind every parameter to NULL; the plan doesn't depend on the values
+                if "?" in stmt:
+                    params = (None,) * stmt.count("?")
+                else:
+                    params = dict.fromkeys(SQL_PARAM.findall(stmt))
+                plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + stmt, params)]
+            except Exception as e:
+                problems.append((location, normalized, f"error: {e}"))
+                continue
+            for detail in plan:
+                full_scan = detail.startswith("SCAN ") and "VIRTUAL TABLE" not in detail and detail != "SCAN CONSTANT ROW"
+                if full_scan and normalized not in FULL_SCAN_OK:
+                    problems.append((location, normalized, detail))
+    return problems
+
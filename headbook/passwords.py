@@ -0,0 +1,94 @@
+import hashlib, hmac, multiprocessing, os, secrets, threading
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+def hash_token(token):
+    """The fixed-length digest we store instead of an access token.
+
+    Tokens are long random strings, so a plain (fast) SHA-256 is enough – there
+    is nothing to brute-force, unlike with passwords.
+    """
+    return hashlib.sha256(token.encode(errors="surrogateescape")).digest()
+
+
+class HashingBusy(Exception):
+    """Raised when too many password hashes are already waiting to be computed"""
+
+
+class PasswordHasher:
+    """Computes and checks password hashes in a pool of worker processes.
+
+    Password hashing is deliberately slow; doing it in a separate process keeps a
+    web worker thread (and, in CPython, the GIL) free for other requests in the
+    meantime. At most `max_pending` hashes may be queued or running at once;
+    beyond that, callers wait up to `wait` seconds and then get HashingBusy.
+
+    With `workers=0`, hashes are computed in the calling thread (handy for the CLI).
+    """
+
+    def __init__(self, method="scrypt:32768:8:1", salt_length=16, workers=2, max_pending=32, wait=10.0):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(timeout=self.wait):
+            raise HashingBusy()
+        try:
+            with self._lock:
+                # a forked web worker can't use its parent's pool, it needs its own
+                if self._pool is None or self._pid != os.getpid():
+                    # spawn rather than fork: forking a process that has threads
+                    # (and open database connections) isn't safe
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                    self._pid = os.getpid()
+            return self._pool.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True if the hash was made with other parameters than the ones we use now"""
+        return pwhash.split("$", 1)[0] != self.method
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+
+class CredentialCache:
+    """Remembers recently verified username/password pairs.
+
+    Entries are keyed by an HMAC (with a random per-process key) of the username,
+    password and stored hash, so the cache never holds a password, and changing
+    the password makes old entries useless.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._key = secrets.token_bytes(32)
+
+    def _digest(self, username, password, pwhash):
+        msg = "\0".join([username, password, pwhash]).encode(errors="surrogateescape")
+        return hmac.new(self._key, msg, hashlib.sha256).digest()
+
+    def verified(self, username, password, pwhash):
+        return self.cache.get(self._digest(username, password, pwhash)) is not None
+
+    def remember(self, username, password, pwhash):
+        self.cache.set(self._digest(username, password, pwhash), True)
@@ -0,0 +1,126 @@
+"""Rate limits and a cap on concurrent requests, per route class.
+
+Each (route class, scope, identity) – e.g. ("login", "ip", "10.0.0.7") – has a
+token bucket that holds up to `burst` tokens and refills at `rate` tokens per
+second. A request takes a token from each of its buckets, and is turned away
+if any of them is empty.
+
+Buckets live in the process (MemoryStore), or in an SQLite file that all the
+workers share (SQLiteStore), so a client can't get around the limits by
+landing on another worker.
+"""
+import os, threading, time
+from collections import OrderedDict
+import apsw
+
+
+def take(state, now, rate, burst):
+    """Take a token from a bucket whose state is (tokens, last update), or None for a full one.
+
+    Returns the new state and 0, or, if the bucket is empty, the new state and
+    the number of seconds until it has a token again.
+    """
+    (tokens, updated) = state or (burst, now)
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return ((tokens - 1, now), 0)
+    return ((tokens, now), (1 - tokens) / rate)
+
+
+class MemoryStore:
+    """Buckets of this process only"""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (tokens, updated), least recently used first
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            (state, wait) = take(self._data.pop(key, None), now, rate, burst)
+            self._data[key] = state
+            if len(self._data) > self.maxsize:
+                # the least recently used bucket has most likely filled up again anyway
+                self._data.popitem(last=False)
+        return wait
+
+
+class SQLiteStore:
+    """Buckets in an SQLite file, shared by all processes that use the same file.
+
+    The file only holds buckets; losing it just resets the limits, so it is
+    written without syncing to disk.
+    """
+
+    PRUNE_EVERY = 1000  # takes between deleting idle buckets
+
+    def __init__(self, path, busy_timeout=1000, max_idle=3600):
+        """Buckets that haven't been used for `max_idle` seconds (and so are full) are deleted now and then"""
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.max_idle = max_idle
+        self._conn = None
+        self._pid = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # connections can't be shared with a forked child; each process opens its own
+        if self._pid != os.getpid():
+            conn = apsw.Connection(self.path)
+            conn.setbusytimeout(self.busy_timeout)
+            conn.pragma("journal_mode", "wal")
+            conn.pragma("synchronous", "off")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL) WITHOUT ROWID;")
+            (self._conn, self._pid) = (conn, os.getpid())
+        return self._conn
+
+    def take(self, key, rate, burst):
+        now = time.time()  # the same clock in every process
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?;", (key,)).fetchone()
+                ((tokens, updated), wait) = take(row, now, rate, burst)
+                conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?);", (key, tokens, updated))
+                self._count += 1
+                if self._count % self.PRUNE_EVERY == 0:
+                    conn.execute("DELETE FROM buckets WHERE updated < ?;", (now - self.max_idle,))
+                conn.execute("COMMIT;")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK;")
+                raise
+        return wait
+
+
+class Limiter:
+    def __init__(self, rules, max_in_flight, store=None):
+        """`rules` is route class -> {scope: (rate, burst)}; `max_in_flight` is route class ->
+        the most requests of that class that may be handled at once (in this process)"""
+        self.rules = rules
+        self.store = store or MemoryStore()
+        self._slots = {route_class: threading.BoundedSemaphore(n) for (route_class, n) in max_in_flight.items()}
+
+    def check(self, route_class, identities):
+        """Take a token from each bucket of a request; `identities` is scope -> who the request
+        is from (e.g. {"ip": ..., "user": ...}). Returns 0 if the request may go ahead,
+        otherwise how many seconds until it might."""
+        wait = 0
+        for (scope, (rate, burst)) in self.rules.get(route_class, {}).items():
+            identity = identities.get(scope)
+            if identity is not None:
+                wait = max(wait, self.store.take(f"{route_class}:{scope}:{identity}", rate, burst))
+        return wait
+
+    def enter(self, route_class):
+        """Claim a slot for a request of `route_class`; False if they are all taken"""
+        slots = self._slots.get(route_class)
+        return slots is None or slots.acquire(blocking=False)
+
+    def leave(self, route_class):
+        slots = self._slots.get(route_class)
+        if slots is not None:
+            slots.release()
@@ -0,0 +1,199 @@
+"""Read-only copies of the database in memory, kept by each process.
+
+Reading from memory doesn't wait for the disk, so reads stay quick while the
+disk is busy with writes. A snapshot of the database is made with SQLite's
+backup API, and a base copy of it is kept in step in two ways:
+
+* statements that this process has committed to the database are executed on
+  the base as well (apply()), and kept in a log;
+* when the database's counters are ahead of the base's (other processes have
+  changed something), a new snapshot and base are made in a background thread
+  and swapped in.
+
+apply() is given the database counters as they were right after the commit.
+If the base's counters don't come out the same, it has missed a change, and
+is dropped until the next refresh rather than serving stale reads.
+
+An SQLite connection can't run queries for two threads at once, so requests
+don't read from the base itself. Each request checks out a copy of its own
+(up to `size` of them), and gives it back when it's done. A copy is made from
+the snapshot, which never changes, outside the replica's lock, and brought up
+to date by replaying the log. When all the copies are taken, requests read
+from the database instead.
+
+The counters decide whether a copy may be used: cursor() only gives one if
+the base is at least as new as the caller's reading of the database counters.
+So only tables that have change counters (users and buddies) should be read
+from the replica.
+"""
+import os, threading, time
+import apsw
+
+
+class Copy:
+    """A copy of the base that one request at a time reads from"""
+
+    def __init__(self):
+        self.conn = None
+        self.base = None    # the number of the snapshot it was made from...
+        self.applied = 0    # ...and how many of the statements logged since it has run
+        self.cursors = []   # handed out since it was checked out
+
+
+class Replica:
+    MAX_LOG = 1000  # statements logged since the snapshot before we make a new one
+
+    def __init__(self, path, size=4, min_interval=0.5, on_refresh=None):
+        """`size` is the most copies to keep for requests; `min_interval` is the least time (s)
+        between two snapshots of the database; `on_refresh` is called with (seconds,
+        exception or None) after each attempt"""
+        self.path = path
+        self.size = size
+        self.min_interval = min_interval
+        self.on_refresh = on_refresh
+        self._reset()
+
+    def _reset(self):
+        # a forked child makes its own copies
+        self._snapshot = None  # (connection, lock for copying from it), never written to
+        self._base = None      # the snapshot plus the statements in the log
+        self._number = 0       # of the snapshot, so copies know when theirs has been replaced
+        self._log = []         # (statement, params) applied to the base since the snapshot
+        self._counters = {}    # the base's
+        self._idle = []
+        self._made = 0
+        self._refreshing = False
+        self._last_refresh = 0.0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def checkout(self):
+        """A copy for the calling request to read from, or None if they're all taken"""
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            if self._made < self.size:
+                self._made += 1
+                return Copy()
+        return None
+
+    def checkin(self, copy):
+        """Give back a copy from checkout(), closing the cursors on it"""
+        if self._pid != os.getpid():
+            return  # checked out before a fork; not ours
+        for cursor in copy.cursors:
+            cursor.close()
+        copy.cursors = []
+        with self._lock:
+            self._idle.append(copy)
+
+    def cursor(self, copy, counters):
+        """A cursor on `copy` if the replica has caught up with `counters` (name -> counter, as
+        read from the database), otherwise None – and a new snapshot is started in the background"""
+        with self._lock:
+            if self._base is None or not self._caught_up(counters):
+                snapshot = None
+            elif copy.base == self._number:
+                return self._replay(copy)
+            else:
+                (snapshot, number) = (self._snapshot, self._number)
+        if snapshot is None:
+            self.refresh_soon()
+            return None
+
+        # a new copy of the snapshot, without holding up the other readers and writers
+        conn = apsw.Connection(":memory:")
+        with snapshot[1]:
+            with conn.backup("main", snapshot[0], "main") as backup:
+                backup.step()
+        with self._lock:
+            if self._number != number:
+                return None  # replaced meanwhile; the next request makes a copy of the new one
+            (copy.conn, copy.base, copy.applied) = (conn, number, 0)
+            return self._replay(copy)
+
+    def _caught_up(self, counters):
+        return all(self._counters.get(name, -1) >= value for (name, value) in counters.items())
+
+    def _replay(self, copy):
+        # bring a copy up to date with the base, and give a cursor on it (with _lock held)
+        try:
+            for (stmt, params) in self._log[copy.applied:]:
+                copy.conn.execute(stmt, params)
+                copy.applied += 1
+        except apsw.Error:
+            copy.base = None  # copy it again next time
+            return None
+        copy.cursors.append(copy.conn.cursor())
+        return copy.cursors[-1]
+
+    def apply(self, statements, counters):
+        """Execute (statement, params) that have been committed to the database on the replica
+        too; `counters` are the database's right after the commit"""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            if self._base is None:
+                return
+            try:
+                for (stmt, params) in statements:
+                    self._base.execute(stmt, params)
+                self._counters = read_counters(self._base)
+            except apsw.Error:
+                self._counters = None
+            if self._counters != counters:
+                # missed a change (or the snapshot already had this one); don't use it until the next one
+                self._base = self._snapshot = None
+            else:
+                self._log.extend(statements)
+        if self._base is None or len(self._log) > self.MAX_LOG:
+            self.refresh_soon()
+
+    def refresh_soon(self):
+        """Start making a new snapshot in the background, unless we're already at it or just did"""
+        with self._lock:
+            if self._refreshing or time.monotonic() - self._last_refresh < self.min_interval:
+                return
+            self._refreshing = True
+            self._last_refresh = time.monotonic()
+        threading.Thread(target=self._refresh, name="replica-refresh", daemon=True).start()
+
+    def refresh(self):
+        """Make a new snapshot now, and use it from now on"""
+        if self._pid != os.getpid():
+            self._reset()
+        source = apsw.Connection(self.path)
+        try:
+            source.setbusytimeout(5000)
+            snapshot = apsw.Connection(":memory:")
+            with snapshot.backup("main", source, "main") as backup:
+                backup.step()  # all pages in one step, so the copy is consistent
+        finally:
+            source.close()
+        base = apsw.Connection(":memory:")
+        with base.backup("main", snapshot, "main") as backup:
+            backup.step()
+        counters = read_counters(base)
+        with self._lock:
+            (self._snapshot, self._base, self._counters, self._log) = ((snapshot, threading.Lock()), base, counters, [])
+            self._number += 1
+
+    def _refresh(self):
+        start = time.perf_counter()
+        error = None
+        try:
+            self.refresh()
+        except apsw.Error as e:
+            error = e
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._last_refresh = time.monotonic()
+        if self.on_refresh:
+            self.on_refresh(time.perf_counter() - start, error)
+
+
+def read_counters(conn):
+    return dict(conn.execute("SELECT name, counter FROM changes;").fetchall())
@@ -0,0 +1,197 @@
+"""Write-behind: statements that change the database are queued, and a writer
+thread commits them in groups.
+
+Committing costs a sync to disk and needs SQLite's single write lock, so one
+commit for a group of statements is much cheaper than one per statement. Each
+statement runs in a savepoint of its own, so a failing one doesn't take the
+rest of its group down with it.
+
+Until a statement is committed, other connections can't see its effect. To
+let a process read its own writes anyway, submit() takes "overlay" entries
+(key -> value) that pending() reports until the statement has been committed.
+Other processes see the change once it is committed, a few milliseconds later.
+
+The writer thread has a database connection of its own, so it never waits for
+a request to give one back.
+"""
+import atexit, os, queue, threading, time
+import apsw
+
+MISSING = object()
+
+
+class WriteTimeout(Exception):
+    """Raised when a statement wasn't queued or committed in time; it may still be committed later"""
+
+
+class Item:
+    def __init__(self, seq, stmt, params, overlay):
+        self.seq = seq
+        self.stmt = stmt
+        self.params = params
+        self.overlay = overlay
+        self.done = threading.Event()
+        self.error = None
+
+
+class Flush:
+    """What happened when a group was committed (passed to the on_commit callback)"""
+
+    def __init__(self, items, seconds, failures, before, after):
+        self.items = items
+        self.seconds = seconds
+        self.failures = failures  # [(item, exception)]
+        self.before = before      # the `changes` counters at the start of the transaction...
+        self.after = after        # ...and just before it was committed
+
+
+class WriteBehind:
+    def __init__(self, connect, interval=0.005, batch_size=500, max_pending=10000, wait=False, timeout=30.0, on_commit=None):
+        """`connect` opens the writer's connection; `interval` is how long (s) to collect
+        statements before committing them; with `wait`, submit() returns only when the
+        statement has been committed. Neither submit() nor flush() waits longer than
+        `timeout` (s)."""
+        self.connect = connect
+        self.interval = interval
+        self.batch_size = batch_size
+        self.wait = wait
+        self.timeout = timeout
+        self.on_commit = on_commit
+        self.seq = 0
+        self._queue = queue.Queue(max_pending)  # a full queue makes submit() wait
+        self._overlay = {}  # key -> (seq, value)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None  # the writer thread's
+        atexit.register(self.flush)
+
+    def submit(self, stmt, params, overlay=()):
+        """Queue a statement. `overlay` is a list of (key, value) for pending() to report
+        until it has been committed; dict values are merged with what's already pending."""
+        self._start()
+        with self._lock:
+            self.seq += 1
+            for (key, value) in overlay:
+                if isinstance(value, dict):
+                    value = {**self._overlay.get(key, (0, {}))[1], **value}
+                self._overlay[key] = (self.seq, value)
+            item = Item(self.seq, stmt, params, overlay)
+        try:
+            self._queue.put(item, timeout=self.timeout)
+        except queue.Full:
+            with self._lock:
+                for key in [k for (k, (seq, _)) in self._overlay.items() if seq == item.seq]:
+                    del self._overlay[key]
+            raise WriteTimeout(f"write queue still full after {self.timeout}s") from None
+        if self.wait:
+            if not item.done.wait(self.timeout):
+                raise WriteTimeout(f"statement not committed after {self.timeout}s")
+            if item.error:
+                raise item.error
+        return item
+
+    def pending(self, key, default=None):
+        """The overlay value for `key`, if a statement that sets it hasn't been committed yet"""
+        entry = self._overlay.get(key)
+        return default if entry is None else entry[1]
+
+    def pending_items(self, kind):
+        """All (key, value) overlay entries whose key starts with `kind`, oldest first"""
+        with self._lock:
+            entries = sorted((seq, key, value) for (key, (seq, value)) in self._overlay.items() if key[0] == kind)
+        return [(key, value) for (_, key, value) in entries]
+
+    def busy(self):
+        """True if anything is waiting to be committed"""
+        return bool(self._overlay) or not self._queue.empty()
+
+    def flush(self):
+        """Wait until everything submitted so far has been committed, or for at most `timeout`
+        seconds; False if that wasn't enough"""
+        if self._pid == os.getpid() and self.seq:
+            try:
+                item = self.submit("SELECT 1;", ())
+            except WriteTimeout:
+                return False
+            return item.done.wait(self.timeout)
+        return True
+
+    def _start(self):
+        # (re)start the writer thread, also in a freshly forked worker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(self._queue.maxsize)
+                self._overlay = {}
+                self._conn = None
+                threading.Thread(target=self._write_loop, name="write-behind", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        start = time.perf_counter()
+        failures = []
+        before = after = {}
+        try:
+            if self._conn is None:
+                self._conn = self.connect()
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE;")
+            before = dict(conn.execute("SELECT name, counter FROM changes;").fetchall())
+            for item in batch:
+                conn.execute("SAVEPOINT item;")
+                try:
+                    conn.execute(item.stmt, item.params)
+                    conn.execute("RELEASE item;")
+                except apsw.Error as e:
+                    conn.execute("ROLLBACK TO item;")
+                    conn.execute("RELEASE item;")
+                    failures.append((item, e))
+            after = dict(conn.execute("SELECT name, counter FROM changes;").fetchall())
+            conn.execute("COMMIT;")
+        except Exception as e:
+            # e.g. the database stayed locked, or can't be opened; the whole group fails,
+            # but the writer thread carries on with the next one
+            failures = [(item, e) for item in batch]
+            self._rollback()
+
+        # the committed values are in the database now; drop their overlay entries,
+        # unless a newer statement has set the same key
+        committed = {item.seq for item in batch}
+        with self._lock:
+            for key in [k for (k, (seq, _)) in self._overlay.items() if seq in committed]:
+                del self._overlay[key]
+        for (item, e) in failures:
+            item.error = e
+        if self.on_commit:
+            try:
+                self.on_commit(Flush(batch, time.perf_counter() - start, failures, before, after))
+            except Exception:
+                pass  # don't let a callback kill the writer thread
+        for item in batch:
+            item.done.set()
+
+    def _rollback(self):
+        conn = self._conn
+        if conn is None or not conn.in_transaction:
+            return
+        try:
+            conn.execute("ROLLBACK;")
+        except apsw.Error:
+            # start over with a new connection for the next group
+            self._conn = None
+            conn.close()
@@ -25,30 +25,35 @@ export async function fetch_json(path, method='GET', headers = {}) {
     }
 }
 
+/**
+ * Get the list of users from the server, one page at a time
+ * 
+ * @param {*} limit Page size (the server picks a default if not given)
+ * @param {*} after Start after the user with this id
+ * @yields A list of simple user objects (only id and username) for each page
+ */
+export async function* list_user_pages(limit, after = 0) {
+    while (after !== null) {
+        const page = await fetch_json(`/users/?after=${after}` + (limit ? `&limit=${limit}` : ''));
+        if (!page) {
+            return;
+        }
+        yield page.users;
+        after = page.next;
+    }
+}
+
 /**
  * Get list of users from server
  * 
  * @returns A list of simple user objects (only id and username)
  */
 export async function list_users() {
-    return await fetch_json('/users') || [];
-}
-
-//This code should not be here
-//I was supposed to use fetch_json to retrieve it from the almost
-//identical method in the User class in app.py, but ran out of time
-export async function get_buddy_status(user1, user2) {
-    if (user1.id == user2.id) {
-        return -1; //Self
-    } else if (!user1.buddies.includes(user2.id) && !user2.buddies.includes(user1.id)) {
-        return 0; //No relation
-    } else if (user1.buddies.includes(user2.id) && !user2.buddies.includes(user1.id)) {
-        return 1; //They have a pending invite
-    } else if (user2.buddies.includes(user1.id) && !user1.buddies.includes(user2.id)) {
-        return 2; //You have a pending invite
-    } else if (user1.buddies.includes(user2.id) && user2.buddies.includes(user1.id)) {
-        return 3; //You are buddies
-    } 
+    const users = [];
+    for await (const page of list_user_pages()) {
+        users.push(...page);
+    }
+    return users;
 }
 
 /**
@@ -60,6 +65,19 @@ export async function get_profile(userid) {
     return await fetch_json(`/users/${userid}`);
 }
 
+/**
+ * Get several user profiles from the server in one request
+ * 
+ * Each profile includes its `buddy_status` relative to the current user
+ * (-1 = self, 0 = none, 1 = you sent a request, 2 = they sent a request, 3 = buddies).
+ * @param {*} userids A list of numeric user ids
+ * @returns A list of user objects (only the ones that exist)
+ */
+export async function get_profiles(userids) {
+    const result = await fetch_json(`/users/batch?ids=${userids.join(',')}`);
+    return result ? result.users : [];
+}
+
 /**
  * Format a key-value field
  * 
@@ -142,7 +160,7 @@ export function format_profile(user, elt, buddy_status) {
  * Get the action to perform and any arguments from the 'data-*' attributes on the button element.
  * 
  * @param {*} element A button element with `data-action="…"` set
- * @returns true if action was performed
+ * @returns The server's response if the action was performed, otherwise false
  */
 export async function do_action(element, current_user_id) {
     let result = false;
@@ -154,11 +172,28 @@ export async function do_action(element, current_user_id) {
         result = await fetch_json(`/remove_buddy/${current_user_id}/${other_user_id}`, 'POST');
     }
 
-    if (result) {
-        location.reload()
-        return result;
-    }
-    return false;
+    return result || false;
+}
+
+/**
+ * Listen for changes to the current user's buddy relations (Server-Sent Events from `/events/`)
+ * 
+ * @param {*} on_change Called with (user id, buddy status) for each user whose relation to us has changed
+ * @returns The EventSource
+ */
+export function watch_buddies(on_change) {
+    const source = new EventSource('/events/');
+    source.addEventListener('buddy', (ev) => {
+        const {user, status} = JSON.parse(ev.data);
+        on_change(user, status);
+    });
+    source.addEventListener('error', () => {
+        // the browser reconnects by itself, unless the server turned us away
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(() => watch_buddies(on_change), 30000);
+        }
+    });
+    return source;
 }
 
 export async function get_buddy_list(user_id) {